@@ -1,29 +1,56 @@
 #------------------------------------------------
 # imports
 #------------------------------------------------
-from datetime import datetime
+from datetime import datetime, timedelta
+import io
 import json
+import os
+import re
+import shutil
+import sqlite3
+import time
+import click
+import hashlib
+import hmac
 from enum import Enum
-from flask import Flask, jsonify, request
+from functools import wraps
+from urllib.parse import urlencode
+from flask import Blueprint, Flask, Response, current_app, has_app_context, jsonify, request, send_from_directory, stream_with_context, url_for
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from sqlalchemy import DDL, column, event, inspect, table
+from sqlalchemy.orm import Session, selectinload
+from cache import create_cache
+from config import config_from_env, engine_options
+from export import FORMATS, check_format, default_format, write_table
+from instrumentation import init_instrumentation
+from intervals import IntervalIndex
+from recommendations import topNeighbours
+from throttle import coalesce, init_throttling, rateLimited
+from serializers import ARCHIVED_LOAN_FIELDS, BOOK_FIELDS, CUSTOMER_FIELDS, LOAN_FIELDS, FastJSONProvider, columnsFor, objectToDict, rowToDict
 # from mockup.initialize import clear_all_models, update_all_tables
 
 #------------------------------------------------
-# configurations 
+# configurations
 #------------------------------------------------
 
-app = Flask(__name__)
+# SQLAlchemy & the routes aren't bound to an app at import time - create_app (end of the file)
+# builds a configured app, see config.py for the configuration objects
+db = SQLAlchemy()
 
-# Enable CORS for all routes
-CORS(app)
+# every route & CLI command of the library (cli_group=None keeps the commands at the top level)
+api = Blueprint('api', __name__, cli_group=None)
 
-# Configurations for the database - sqlite
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///library.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-#init SQLAlchemy
-db = SQLAlchemy(app)
+# applies SQLITE_PRAGMAS on every new sqlite connection of an engine's pool
+def sqlitePragmasListener(pragmas):
+    def setSqlitePragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute(f"PRAGMA {pragma}={value}")
+        cursor.close()
+    return setSqlitePragmas
 
 #------------------------------------------------
 # models definition & ENUM
@@ -34,14 +61,28 @@ class LoanType(Enum):
     MEDIUM_TERM = 2  # Up to 5 days
     LONG_TERM = 3   # Up to 2 days
 
+# maximum loan period in days, by LoanType value (= Book.type)
+LOAN_PERIOD_DAYS = {
+    LoanType.SHORT_TERM.value: 10,
+    LoanType.MEDIUM_TERM.value: 5,
+    LoanType.LONG_TERM.value: 2,
+}
+
 # Book model
 class Book(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    name = db.Column(db.String(255), nullable=False)
-    author = db.Column(db.String(255), nullable=False)
+    name = db.Column(db.String(255), nullable=False, index=True)     # indexed for name prefix lookups
+    author = db.Column(db.String(255), nullable=False, index=True)
     year_published = db.Column(db.Integer, nullable=True)
     type = db.Column(db.Integer, db.CheckConstraint('type IN (1, 2, 3)'), nullable=False)  # Using integer enum
-    is_available = db.Column(db.Boolean, default=True, nullable=False)
+    is_available = db.Column(db.Boolean, default=True, nullable=False, index=True)
+    deleted_at = db.Column(db.DateTime, nullable=True, index=True)    # soft delete - the loan history keeps pointing at the book
+
+    # composite indexes for the common /listBooks filter combinations
+    __table_args__ = (
+        db.Index('ix_book_author_year', 'author', 'year_published'),
+        db.Index('ix_book_type_available', 'type', 'is_available'),
+    )
 
     def __repr__(self):
         return f"<Book {self.name}>"
@@ -50,8 +91,9 @@ class Book(db.Model):
 class Customer(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(255), nullable = False)
-    city = db.Column(db.String(255), nullable=True)
+    city = db.Column(db.String(255), nullable=True, index=True)
     age = db.Column(db.String(255), nullable=True)
+    deleted_at = db.Column(db.DateTime, nullable=True, index=True)    # soft delete - the loan history keeps pointing at the customer
 
     def __repr__(self):
         return f"<Customer {self.name}>"
@@ -59,10 +101,17 @@ class Customer(db.Model):
 # Loan model
 class Loan(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True, nullable=False)  # Primary Key, autoincrement
-    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)  # Foreign key from Customer model
-    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False)         # Foreign key from Book model
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False, index=True)  # Foreign key from Customer model
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False, index=True)         # Foreign key from Book model
     loan_date = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)       # Default to current date/time
-    return_date = db.Column(db.DateTime, nullable=True)                               # Can be null if not returned yet
+    return_date = db.Column(db.DateTime, nullable=True, index=True)                   # Can be null if not returned yet
+    due_date = db.Column(db.DateTime, nullable=True, index=True)                      # loan_date + LOAN_PERIOD_DAYS of the book type
+
+    # composite indexes for the common /listLoans filter combinations
+    __table_args__ = (
+        db.Index('ix_loan_customer_loan_date', 'customer_id', 'loan_date'),
+        db.Index('ix_loan_book_period', 'book_id', 'loan_date', 'return_date'),   # also the booking calendar of a book
+    )
 
     # Establish relationships (assuming you have Customer and Book models)
     customer = db.relationship('Customer', backref='loans', lazy=True)
@@ -71,6 +120,820 @@ class Loan(db.Model):
     def __repr__(self):
         return f"<Loan ID: {self.id}, Customer: {self.customer_id}, Book: {self.book_id}, Loan Date: {self.loan_date}>"
 
+#------------------------------------------------
+# Loan periods & due dates
+#------------------------------------------------
+
+# SQL expression of loan_date + the loan period of the book type
+def dueDateExpression(loanDate, bookType):
+    if db.engine.dialect.name == 'sqlite':
+        modifier = db.case({bookType_: f'+{days} days' for bookType_, days in LOAN_PERIOD_DAYS.items()}, value=bookType)
+        return db.func.datetime(loanDate, modifier, type_=db.DateTime)
+    days = db.case(LOAN_PERIOD_DAYS, value=bookType)
+    return loanDate + db.func.make_interval(0, 0, 0, days)
+
+# materializes Loan.due_date when a loan is created or moved to another date/book through the ORM
+@event.listens_for(Loan, 'before_insert')
+@event.listens_for(Loan, 'before_update')
+def setLoanDueDate(mapper, connection, loan):
+    state = db.inspect(loan)
+    if loan.due_date is not None and not state.attrs.loan_date.history.has_changes() \
+            and not state.attrs.book_id.history.has_changes():
+        return
+    if loan.loan_date is None:
+        loan.loan_date = datetime.utcnow()
+    bookType = connection.execute(db.select(Book.type).where(Book.id == loan.book_id)).scalar()
+    loan.due_date = loan.loan_date + timedelta(days=LOAN_PERIOD_DAYS[bookType]) if bookType else None
+
+# fills Loan.due_date with a single UPDATE - for rows written by bulk statements (only_missing)
+# or for every loan after the loan periods changed
+def refresh_due_dates(only_missing=True):
+    bookType = db.select(Book.type).where(Book.id == Loan.book_id).scalar_subquery()
+    statement = db.update(Loan).values(due_date=dueDateExpression(Loan.loan_date, bookType))
+    if only_missing:
+        statement = statement.where(Loan.due_date.is_(None))
+    updated = db.session.execute(statement.execution_options(synchronize_session=False)).rowcount
+    db.session.commit()
+    return updated
+
+@api.cli.command('refresh-due-dates')
+@click.option('--all', 'refresh_all', is_flag=True, help='Recompute every loan, not only the ones without a due date.')
+def refreshDueDatesCommand(refresh_all):
+    updated = refresh_due_dates(only_missing=not refresh_all)
+    if updated:
+        logChanges([('loan', None, 'reload', None)])
+        db.session.commit()
+    click.echo(f"Due dates updated for {updated} loans.")
+
+# a loan is overdue when it is still open past its due date
+def loanIsOverdue(now=None):
+    now = now or datetime.utcnow()
+    return db.and_(Loan.due_date < now, loanIsOpen(now))
+
+#------------------------------------------------
+# Bookings - the loans of a book never overlap, future loans are reservations
+#------------------------------------------------
+
+# A loan holds the copy over [loan_date, end): end is the return date, or the due date while the loan
+# is open (the copy is expected back by then) - unbounded when neither is known.
+def loanEnd(loans):
+    return db.func.coalesce(loans.c.return_date, loans.c.due_date)
+
+class BookingConflict(Exception):
+    pass
+
+def loanPeriodChanged(loan):
+    state = db.inspect(loan)
+    return any(state.attrs[name].history.has_changes() for name in ('book_id', 'loan_date', 'return_date'))
+
+# stands in for an unbounded end in the index seeks below
+END_OF_TIME = datetime(9999, 12, 31)
+
+# Loans created or moved through the ORM (createLoan, checkoutBook, updateLoan, /batchLoans) are checked
+# against the other loans of their book once flushed. The stored loans of a book don't overlap, so sorted
+# by start their ends are sorted too, and if any two loans overlap, two neighbours do - one of them written.
+# So each written loan is only compared with the loan of its book starting last before its end: one
+# backward index seek on ix_loan_book_period (book_id = ? AND loan_date < ?) per written loan, all in one
+# query, the loans of the same batch included. The book rows are locked first (FOR UPDATE, a no-op on
+# SQLite where writers are serialized anyway), so two transactions can't book the same period concurrently.
+# Bulk imports are trusted and not checked.
+@event.listens_for(Session, 'after_flush')
+def rejectOverlappingLoans(session, flush_context):
+    loans = [loan for loan in session.new if isinstance(loan, Loan)]
+    loans += [loan for loan in session.dirty if isinstance(loan, Loan) and loanPeriodChanged(loan)]
+    if not loans:
+        return
+
+    connection = session.connection()
+    connection.execute(db.select(Book.id).where(Book.id.in_({loan.book_id for loan in loans})).with_for_update())
+    written, other, previous = (Loan.__table__.alias(name) for name in ('written', 'other', 'previous'))
+    writtenEnd, previousEnd = loanEnd(written), loanEnd(previous)
+    previousID = (
+        db.select(other.c.id)
+        .where(other.c.book_id == written.c.book_id, other.c.id != written.c.id,
+               other.c.loan_date < db.func.coalesce(writtenEnd, END_OF_TIME))
+        .order_by(other.c.loan_date.desc())
+        .limit(1)
+        .correlate(written)
+        .scalar_subquery()
+    )
+    conflict = connection.execute(
+        db.select(written.c.book_id, previous.c.id, previous.c.loan_date, previousEnd.label('end'))
+        .select_from(written.join(previous, previous.c.id == previousID))
+        .where(written.c.id.in_([loan.id for loan in loans]),
+               db.or_(previousEnd.is_(None), previousEnd > written.c.loan_date))
+        .limit(1)
+    ).first()
+    if conflict:
+        until = f"{conflict.end:%Y-%m-%d %H:%M}" if conflict.end else "further notice"
+        raise BookingConflict(f"Book with ID {conflict.book_id} is already booked from "
+                              f"{conflict.loan_date:%Y-%m-%d %H:%M} until {until} (loan {conflict.id}).")
+
+# interval index of the loans of a book, from one ordered range scan of ix_loan_book_period.
+# Kept in the response cache per book and keyed by the loan generation of that book (see
+# touchBookLoans): any window of the book is answered from memory until one of its loans changes,
+# writes to the loans of other books keep it.
+def bookIntervals(bookID):
+    cache = responseCache()
+    key = f"intervals:book:{bookID}|{tableGenerations(('loan:books', f'loan:book:{bookID}'))}"
+    index = cache.get(key) if cache is not None else None
+    if index is None:
+        rows = db.session.execute(
+            db.select(Loan.loan_date, loanEnd(Loan.__table__), Loan.id)
+            .where(Loan.book_id == bookID)
+            .order_by(Loan.loan_date)
+        ).all()
+        index = IntervalIndex()
+        for loanDate, end, loanID in rows:
+            index.append(loanDate, end, loanID)
+        if cache is not None:
+            cache.set(key, index)
+    return index
+
+#------------------------------------------------
+# Loan summary tables (precomputed report aggregates)
+#------------------------------------------------
+
+# loans per book / customer / month, kept up to date incrementally when REPORT_SUMMARIES is on
+class BookLoanStats(db.Model):
+    book_id = db.Column(db.Integer, primary_key=True)
+    loan_count = db.Column(db.Integer, nullable=False, default=0)
+
+class CustomerLoanStats(db.Model):
+    customer_id = db.Column(db.Integer, primary_key=True)
+    loan_count = db.Column(db.Integer, nullable=False, default=0)
+
+class MonthlyLoanStats(db.Model):
+    month = db.Column(db.String(7), primary_key=True)   # YYYY-MM
+    loan_count = db.Column(db.Integer, nullable=False, default=0)
+
+# (model, key column, SQL expression of the key over a table of loans, python key of a loan)
+LOAN_SUMMARIES = [
+    (BookLoanStats, 'book_id', lambda loans: loans.c.book_id, lambda bookID, customerID, loanDate: bookID),
+    (CustomerLoanStats, 'customer_id', lambda loans: loans.c.customer_id, lambda bookID, customerID, loanDate: customerID),
+    (MonthlyLoanStats, 'month', lambda loans: monthExpression(loans.c.loan_date), lambda bookID, customerID, loanDate: loanDate.strftime('%Y-%m')),
+]
+
+# YYYY-MM of a datetime column
+def monthExpression(dateColumn):
+    if db.engine.dialect.name == 'sqlite':
+        return db.func.strftime('%Y-%m', dateColumn)
+    return db.func.to_char(dateColumn, 'YYYY-MM')
+
+# adds the given deltas ({key: +/-n}) to a summary table with one executemany upsert
+def applySummaryDeltas(connection, model, keyColumn, deltas):
+    rows = [{keyColumn: key, 'loan_count': delta} for key, delta in deltas.items() if delta]
+    if not rows:
+        return
+    statement = dialectInsert()(model.__table__)
+    statement = statement.on_conflict_do_update(
+        index_elements=[keyColumn],
+        set_={'loan_count': model.__table__.c.loan_count + statement.excluded.loan_count}
+    )
+    connection.execute(statement, rows)
+
+# (book_id, customer_id, loan_date) of a loan as it is stored in the database, before pending changes
+def committedLoanKey(loan):
+    state = db.inspect(loan)
+    return tuple(
+        state.attrs[name].history.deleted[0] if state.attrs[name].history.deleted else getattr(loan, name)
+        for name in ('book_id', 'customer_id', 'loan_date')
+    )
+
+# incremental refresh: every loan inserted / deleted / moved through the ORM adjusts the counters
+# in the same transaction
+@event.listens_for(Session, 'after_flush')
+def updateLoanSummaries(session, flush_context):
+    if not current_app.config['REPORT_SUMMARIES']:
+        return
+
+    changes = []   # (book_id, customer_id, loan_date, +1/-1)
+    for loan in session.new:
+        if isinstance(loan, Loan):
+            changes.append((loan.book_id, loan.customer_id, loan.loan_date, 1))
+    for loan in session.deleted:
+        if isinstance(loan, Loan):
+            changes.append((*committedLoanKey(loan), -1))
+    for loan in session.dirty:
+        if isinstance(loan, Loan):
+            state = db.inspect(loan)
+            if not any(state.attrs[name].history.has_changes() for name in ('book_id', 'customer_id', 'loan_date')):
+                continue
+            changes.append((*committedLoanKey(loan), -1))
+            changes.append((loan.book_id, loan.customer_id, loan.loan_date, 1))
+
+    if not changes:
+        return
+    connection = session.connection()
+    for model, keyColumn, _, keyOf in LOAN_SUMMARIES:
+        deltas = {}
+        for bookID, customerID, loanDate, delta in changes:
+            key = keyOf(bookID, customerID, loanDate)
+            deltas[key] = deltas.get(key, 0) + delta
+        applySummaryDeltas(connection, model, keyColumn, deltas)
+
+# bulk statements bypass the ORM hooks - call before deleting the loans matching the condition
+# (one grouped, index backed query per summary table)
+def subtractLoansFromSummaries(condition):
+    if not current_app.config['REPORT_SUMMARIES']:
+        return
+    connection = db.session.connection()
+    for model, keyColumn, keyExpression, _ in LOAN_SUMMARIES:
+        key = keyExpression(Loan.__table__)
+        counts = db.session.execute(db.select(key, db.func.count()).where(condition).group_by(key)).all()
+        applySummaryDeltas(connection, model, keyColumn, {row[0]: -row[1] for row in counts})
+
+# (book_id, customer_id, loan_date) of the live & archived loans - archiving moves loans out of the
+# hot table, the reports keep counting them
+def allLoansSubquery():
+    return db.union_all(
+        db.select(Loan.book_id, Loan.customer_id, Loan.loan_date),
+        db.select(LoanArchive.book_id, LoanArchive.customer_id, LoanArchive.loan_date),
+    ).subquery()
+
+# recomputes every summary table from the loan & loan_archive tables with INSERT ... SELECT ... GROUP BY
+def rebuild_loan_summaries():
+    loans = allLoansSubquery()
+    for model, keyColumn, keyExpression, _ in LOAN_SUMMARIES:
+        key = keyExpression(loans)
+        db.session.execute(db.delete(model))
+        db.session.execute(db.insert(model).from_select(
+            [keyColumn, 'loan_count'],
+            db.select(key, db.func.count()).group_by(key)
+        ))
+    db.session.commit()
+    print("Loan summary tables rebuilt.")
+
+@api.cli.command('rebuild-reports')
+def rebuildReportsCommand():
+    rebuild_loan_summaries()
+
+#------------------------------------------------
+# Loan archive - returned loans older than ARCHIVE_AFTER_DAYS leave the hot loan table
+#------------------------------------------------
+
+# same columns as loan, no foreign keys (books & customers are only soft deleted anyway)
+class LoanArchive(db.Model):
+    __tablename__ = 'loan_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    customer_id = db.Column(db.Integer, nullable=False)
+    book_id = db.Column(db.Integer, nullable=False)
+    loan_date = db.Column(db.DateTime, nullable=False)
+    return_date = db.Column(db.DateTime, nullable=False)
+    due_date = db.Column(db.DateTime, nullable=True)
+    archived_at = db.Column(db.DateTime, nullable=False)
+
+    # history lookups per customer / book over time
+    __table_args__ = (
+        db.Index('ix_loan_archive_customer_loan_date', 'customer_id', 'loan_date'),
+        db.Index('ix_loan_archive_book_loan_date', 'book_id', 'loan_date'),
+    )
+
+# Moves the loans returned more than `days` ago to loan_archive, batch_size loans per transaction
+# (INSERT ... SELECT + DELETE, so a batch is either still in loan or already in the archive).
+# Summary tables are left alone - archived loans still count in the reports. Returns the number of loans moved.
+def archive_loans(days=None, batch_size=None, now=None):
+    days = current_app.config['ARCHIVE_AFTER_DAYS'] if days is None else days
+    batch_size = batch_size or current_app.config['ARCHIVE_BATCH_SIZE']
+    now = now or datetime.utcnow()
+    horizon = now - timedelta(days=days)
+    names = list(LOAN_FIELDS)
+
+    # sqlite hands out max(rowid) + 1 as the next id: keeping the newest loan in the table
+    # guarantees that archived ids are never reused by a new loan
+    newestID = db.session.scalar(db.select(db.func.max(Loan.id)))
+    moved = 0
+    while True:
+        loanIDs = db.session.scalars(
+            db.select(Loan.id)
+            .where(Loan.return_date < horizon, Loan.id < newestID)
+            .order_by(Loan.id).limit(batch_size)
+        ).all()
+        if not loanIDs:
+            break
+
+        # upsert, a loan re-imported after it was archived replaces its archived copy
+        statement = dialectInsert()(LoanArchive.__table__).from_select(
+            names + ['archived_at'],
+            db.select(*[Loan.__table__.c[name] for name in names], db.literal(now, db.DateTime)).where(Loan.id.in_(loanIDs))
+        )
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=['id'], set_={name: statement.excluded[name] for name in names[1:] + ['archived_at']}
+        ))
+        db.session.execute(db.delete(Loan).where(Loan.id.in_(loanIDs)).execution_options(synchronize_session=False))
+        logChanges([('loan', loanID, 'archive', None) for loanID in loanIDs])
+        db.session.commit()
+        moved += len(loanIDs)
+    return moved
+
+@api.cli.command('archive-loans')
+@click.option('--days', type=click.IntRange(min=0), help='Archive loans returned more than this many days ago (default ARCHIVE_AFTER_DAYS).')
+@click.option('--batch-size', type=click.IntRange(min=1), help='Loans moved per transaction (default ARCHIVE_BATCH_SIZE).')
+def archiveLoansCommand(days, batch_size):
+    click.echo(f"{archive_loans(days, batch_size)} loans archived.")
+
+#------------------------------------------------
+# Book full-text search index (SQLite FTS5)
+#------------------------------------------------
+
+# external content FTS5 table over book.name & book.author, kept in sync with the
+# book table by triggers so ORM writes and bulk statements are both covered
+bookFts = table('book_fts', column('rowid'), column('book_fts'))
+
+BOOK_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS book_fts USING fts5(
+        name, author, content='book', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_ai AFTER INSERT ON book BEGIN
+        INSERT INTO book_fts(rowid, name, author) VALUES (new.id, new.name, new.author);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_ad AFTER DELETE ON book BEGIN
+        INSERT INTO book_fts(book_fts, rowid, name, author) VALUES ('delete', old.id, old.name, old.author);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_au AFTER UPDATE OF name, author ON book BEGIN
+        INSERT INTO book_fts(book_fts, rowid, name, author) VALUES ('delete', old.id, old.name, old.author);
+        INSERT INTO book_fts(rowid, name, author) VALUES (new.id, new.name, new.author);
+    END""",
+]
+
+for statement in BOOK_FTS_DDL:
+    event.listen(Book.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(Book.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS book_fts').execute_if(dialect='sqlite'))
+
+# (re)creates the FTS table & triggers and reindexes every book - for databases created before the index existed
+def rebuild_book_search_index():
+    if db.engine.dialect.name != 'sqlite':
+        print("Full-text index is only available on SQLite, search falls back to LIKE.")
+        return
+    for statement in BOOK_FTS_DDL:
+        db.session.execute(DDL(statement))
+    db.session.execute(db.text("INSERT INTO book_fts(book_fts) VALUES ('rebuild')"))
+    db.session.commit()
+    print("Book search index rebuilt.")
+
+@api.cli.command('rebuild-search-index')
+def rebuildSearchIndexCommand():
+    rebuild_book_search_index()
+
+
+#------------------------------------------------
+# Response cache
+#------------------------------------------------
+
+# the cache of the current app (None when CACHE_BACKEND is 'none' or outside an app context)
+def responseCache():
+    return current_app.extensions.get('response_cache') if has_app_context() else None
+
+# Every cached response is keyed by endpoint + query params + the generation of each table it
+# reads. Commits that wrote to a table bump its generation, so stale entries are never served again.
+# The generations have to be seen by every process writing the database: Redis keeps them next to
+# the entries, the per process memory cache reads them from the table_generation table, bumped in
+# the transaction of the write (one primary key lookup per cached request). Without a cache they are
+# counted per process - they still key request coalescing, so a request never joins a computation
+# started before a write it could have seen.
+localGenerations = {}
+
+class TableGeneration(db.Model):
+    __tablename__ = 'table_generation'
+    name = db.Column(db.String(64), primary_key=True)   # table name, or loan:book:<id> (see touchBookLoans)
+    generation = db.Column(db.Integer, nullable=False)
+
+def generationsInDatabase(cache):
+    return cache is not None and not cache.shared
+
+def storedGenerationsStatement(tables):
+    return db.select(TableGeneration.name, TableGeneration.generation).where(TableGeneration.name.in_(tables))
+
+def generationsKey(tables, generations):
+    return ','.join(f"{name}:{generations.get(name, 0)}" for name in tables)
+
+def tableGenerations(tables):
+    cache = responseCache()
+    if cache is None:
+        return generationsKey(tables, localGenerations)
+    if generationsInDatabase(cache):
+        return generationsKey(tables, dict(db.session.execute(storedGenerationsStatement(tables)).all()))
+    return ','.join(f"{name}:{cache.get_counter('generation:' + name)}" for name in tables)
+
+def invalidateTables(tables):
+    for name in tables:
+        # not atomic, but concurrent bumps still move the generation away from the old value
+        localGenerations[name] = localGenerations.get(name, 0) + 1
+    cache = responseCache()
+    if cache is None or generationsInDatabase(cache):
+        return
+    for name in tables:
+        cache.incr('generation:' + name)
+
+# generations: tableGenerations(tables) unless read already (asgi.py reads them asynchronously)
+def responseCacheKey(path, args, tables, generations=None):
+    generations = tableGenerations(tables) if generations is None else generations
+    return f"response:{path}?{urlencode(sorted(args.items(multi=True)))}|{generations}"
+
+# runs a view into a plain (picklable, shareable) description of its response
+def renderForCache(view, args, kwargs):
+    response = current_app.make_response(view(*args, **kwargs))
+    body = response.get_data()
+    return {
+        'status': response.status_code,
+        'body': body,
+        'mimetype': response.mimetype,
+        'headers': {name: value for name, value in response.headers.items() if name.startswith('X-')},
+        'etag': hashlib.sha1(body).hexdigest(),
+    }
+
+# Loan writes also bump a generation per book ('loan:book:<id>', read by bookIntervals), so a write
+# only invalidates what was derived from the loans of the books it touched. Core statements on the
+# loan table bump 'loan:books' (every book) instead, unless they run with
+# execution_options(loan_books_tracked=True) and report their books here themselves.
+def touchBookLoans(bookIDs, session=None):
+    session = session or db.session
+    session.info.setdefault('changed_tables', set()).update(f'loan:book:{bookID}' for bookID in bookIDs)
+
+# collect the tables written by ORM flushes ...
+@event.listens_for(Session, 'after_flush')
+def trackFlushedTables(session, flush_context):
+    changed = session.info.setdefault('changed_tables', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if hasattr(obj, '__table__'):
+            changed.add(obj.__table__.name)
+        if isinstance(obj, Loan):
+            # a loan moved to another book changes both
+            touchBookLoans({obj.book_id, committedLoanKey(obj)[0]}, session)
+
+# ... and by bulk insert/update/delete statements
+@event.listens_for(Session, 'do_orm_execute')
+def trackExecutedTables(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        statementTable = getattr(orm_execute_state.statement, 'table', None)
+        if statementTable is not None:
+            changed = orm_execute_state.session.info.setdefault('changed_tables', set())
+            changed.add(statementTable.name)
+            if statementTable.name == Loan.__table__.name and not orm_execute_state.execution_options.get('loan_books_tracked'):
+                changed.add('loan:books')
+
+# bumps the stored generations of the written tables in the committing transaction
+@event.listens_for(Session, 'before_commit')
+def bumpStoredGenerations(session):
+    if not generationsInDatabase(responseCache()):
+        return
+    session.flush()   # the tables of pending objects are only known once flushed
+    names = session.info.get('changed_tables')
+    if not names:
+        return
+    statement = dialectInsert()(TableGeneration.__table__)
+    session.connection().execute(
+        statement.on_conflict_do_update(index_elements=['name'], set_={'generation': TableGeneration.__table__.c.generation + 1}),
+        [{'name': name, 'generation': 1} for name in sorted(names)]
+    )
+
+@event.listens_for(Session, 'after_commit')
+def invalidateCommittedTables(session):
+    invalidateTables(session.info.pop('changed_tables', ()))
+
+@event.listens_for(Session, 'after_rollback')
+def discardChangedTables(session):
+    session.info.pop('changed_tables', None)
+
+# read-through cache + ETag / If-None-Match for GET endpoints depending on the given tables.
+# On a miss, concurrent identical requests are coalesced: one runs the view, the others get its
+# response (throttle.coalesce). Streamed requests bypass both, errors are never cached.
+def cachedResponse(*tables):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.args.get('stream'):
+                return view(*args, **kwargs)
+
+            cache = responseCache()
+            key = responseCacheKey(request.path, request.args, tables)
+            cached = cache.get(key) if cache is not None else None
+            if cached is None:
+                cached, shared = coalesce(key, lambda: renderForCache(view, args, kwargs))
+                if cached['status'] != 200:
+                    return Response(cached['body'], status=cached['status'], mimetype=cached['mimetype'], headers=cached['headers'])
+                if cache is not None and not shared:
+                    cache.set(key, cached)
+
+            if cached['etag'] in request.if_none_match:
+                response = Response(status=304)
+            else:
+                response = Response(cached['body'], status=200, mimetype=cached['mimetype'], headers=cached['headers'])
+            response.set_etag(cached['etag'])
+            return response
+        return wrapper
+    return decorator
+
+#------------------------------------------------
+# Change log - append-only feed of every book / customer / loan mutation (/changes)
+#------------------------------------------------
+
+# one row per changed entity, written in the transaction of the change. seq only grows
+# (AUTOINCREMENT, never reused) and writers are serialized - by SQLite itself, by an advisory lock
+# held until commit on PostgreSQL (see lockChangeLog) - so seq order is commit order and a consumer
+# reading past `since` never misses a row committed later with a lower seq.
+#   op   - create | update | delete, archive (loan moved to loan_archive), reload (bulk import,
+#          entity_id is null: resync the whole entity from the list endpoints)
+#   data - JSON of the row after the change (same fields as the list endpoints), null for delete/archive/reload
+class ChangeLog(db.Model):
+    __tablename__ = 'change_log'
+    __table_args__ = {'sqlite_autoincrement': True}
+    seq = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=True)
+    op = db.Column(db.String(10), nullable=False)
+    data = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, index=True)
+
+# models whose mutations are logged -> fields of the data snapshot
+CHANGE_LOGGED = {Book: BOOK_FIELDS, Customer: CUSTOMER_FIELDS, Loan: LOAN_FIELDS}
+
+# PostgreSQL advisory lock key of the change log writers (arbitrary, unique to this app)
+CHANGE_LOG_LOCK = 7305893
+
+# Sequence values are handed out at insert time, so on PostgreSQL writing transactions hold an advisory
+# lock until they commit: a transaction logging later also commits later. It is taken before the first
+# write of the transaction (flush or DML statement), so it always comes before the row locks - two
+# writers can't each hold a row lock the other waits for. Read-only transactions never take it.
+def lockChangeLog(session):
+    if session.info.get('change_log_locked'):
+        return
+    connection = session.connection()
+    if connection.dialect.name == 'postgresql':
+        connection.execute(db.text("SELECT pg_advisory_xact_lock(:key)"), {'key': CHANGE_LOG_LOCK})
+    session.info['change_log_locked'] = True
+
+@event.listens_for(Session, 'before_flush')
+def lockChangeLogBeforeFlush(session, flush_context, instances):
+    if session.new or session.dirty or session.deleted:
+        lockChangeLog(session)
+
+@event.listens_for(Session, 'do_orm_execute')
+def lockChangeLogBeforeStatement(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        lockChangeLog(orm_execute_state.session)
+
+@event.listens_for(Session, 'after_transaction_end')
+def releaseChangeLogLock(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('change_log_locked', None)
+
+# appends changes [(entity, entity_id, op, data dict or None)] in the current transaction
+def logChanges(changes, connection=None):
+    if not changes:
+        return
+    lockChangeLog(db.session)   # a no-op when an earlier write of the transaction took it
+    connection = connection or db.session.connection()
+    now = datetime.utcnow()
+    connection.execute(db.insert(ChangeLog), [
+        {'entity': entity, 'entity_id': entityID, 'op': op,
+         'data': current_app.json.dumps(data) if data is not None else None, 'created_at': now}
+        for entity, entityID, op, data in changes
+    ])
+
+# logs rows changed by a Core UPDATE ... RETURNING (columnsFor the model's fields)
+def logReturnedRows(model, rows, op='update'):
+    fields = CHANGE_LOGGED[model]
+    logChanges([(model.__table__.name, row.id, op, rowToDict(row, fields)) for row in rows])
+
+# ORM writes are logged automatically once flushed (ids assigned) ...
+@event.listens_for(Session, 'after_flush')
+def logFlushedChanges(session, flush_context):
+    changes = []
+    for obj in session.new:
+        fields = CHANGE_LOGGED.get(type(obj))
+        if fields:
+            changes.append((obj.__table__.name, obj.id, 'create', objectToDict(obj, fields)))
+    for obj in session.dirty:
+        fields = CHANGE_LOGGED.get(type(obj))
+        if fields and session.is_modified(obj):
+            softDeleted = getattr(obj, 'deleted_at', None) is not None and db.inspect(obj).attrs.deleted_at.history.has_changes()
+            if softDeleted:
+                changes.append((obj.__table__.name, obj.id, 'delete', None))
+                continue
+            data = objectToDict(obj, fields)
+            if isinstance(obj, Loan):
+                # a loan moved to another book / customer also carries where it was
+                bookID, customerID, _ = committedLoanKey(obj)
+                if (bookID, customerID) != (obj.book_id, obj.customer_id):
+                    data['previous'] = {'book_id': bookID, 'customer_id': customerID}
+            changes.append((obj.__table__.name, obj.id, 'update', data))
+    for obj in session.deleted:
+        if type(obj) in CHANGE_LOGGED:
+            changes.append((obj.__table__.name, obj.id, 'delete', None))
+    logChanges(changes, session.connection())
+
+# ... Core statements log through logChanges / logReturnedRows where they are executed
+
+# removes the entries older than `days` (CHANGES_RETENTION_DAYS by default)
+def prune_change_log(days=None):
+    days = current_app.config['CHANGES_RETENTION_DAYS'] if days is None else days
+    pruned = db.session.execute(
+        db.delete(ChangeLog).where(ChangeLog.created_at < datetime.utcnow() - timedelta(days=days))
+    ).rowcount
+    db.session.commit()
+    return pruned
+
+@api.cli.command('prune-changes')
+@click.option('--days', type=click.IntRange(min=0), help='Keep this many days of changes (default CHANGES_RETENTION_DAYS).')
+def pruneChangesCommand(days):
+    click.echo(f"{prune_change_log(days)} change log entries pruned.")
+
+#------------------------------------------------
+# Recommendations - precomputed "also borrowed" neighbours of every book (see recommendations.py)
+#------------------------------------------------
+
+# the RECOMMENDATIONS_TOP_K most similar books of each book, rebuilt offline by refresh-recommendations
+class BookSimilarity(db.Model):
+    book_id = db.Column(db.Integer, primary_key=True)
+    similar_book_id = db.Column(db.Integer, primary_key=True)
+    score = db.Column(db.Float, nullable=False)              # cosine similarity of the two books' borrowers
+    co_borrowers = db.Column(db.Integer, nullable=False)     # customers who borrowed both
+
+# change log position the similarities are up to date with (a single row)
+class RecommendationRefresh(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    last_seq = db.Column(db.Integer, nullable=False, default=0)
+    refreshed_at = db.Column(db.DateTime, nullable=True)
+
+# distinct (customer_id, book_id) of the live & archived loans, in batches of batch_size rows
+def borrowBatches(batch_size):
+    borrows = db.union(
+        db.select(Loan.customer_id, Loan.book_id),
+        db.select(LoanArchive.customer_id, LoanArchive.book_id),
+    )
+    for batch in db.session.execute(borrows.execution_options(yield_per=batch_size)).partitions():
+        yield batch
+
+# books whose neighbours change when the given books get new borrowers: themselves and every
+# book sharing a borrower with them (their similarity to the changed books moved)
+def booksBorrowedAlongside(bookIDs):
+    loans = db.union_all(
+        db.select(Loan.customer_id, Loan.book_id),
+        db.select(LoanArchive.customer_id, LoanArchive.book_id),
+    ).subquery()
+    borrowers = db.select(loans.c.customer_id).where(loans.c.book_id.in_(bookIDs))
+    return set(db.session.scalars(db.select(loans.c.book_id).where(loans.c.customer_id.in_(borrowers)).distinct())) | set(bookIDs)
+
+# Recomputes the neighbours of the books touched by the loans created / updated since the last refresh
+# (read from the change log), or of every book when full=True. Falls back to a full refresh the first
+# time, after a bulk import (reload), a loan delete, a loan moved to another book or customer (its old
+# borrow may be gone, like a delete) or when the change log was pruned past the last refresh.
+# Returns the number of books refreshed.
+def refresh_recommendations(full=False, batch_size=None):
+    batch_size = batch_size or current_app.config['RECOMMENDATIONS_BATCH_SIZE']
+    state = db.session.get(RecommendationRefresh, 1) or RecommendationRefresh(id=1, last_seq=0)
+    lastSeq = db.session.scalar(db.select(db.func.max(ChangeLog.seq))) or 0
+
+    books = None
+    if not full and state.refreshed_at is not None and not changesPruned(state.last_seq):
+        changes = db.session.execute(
+            db.select(ChangeLog.op, ChangeLog.data)
+            .where(ChangeLog.entity == 'loan', ChangeLog.seq > state.last_seq, ChangeLog.seq <= lastSeq)
+        ).all()
+        changes = [(op, json.loads(data) if data else None) for op, data in changes]
+        if not any(op in ('reload', 'delete') or (data and 'previous' in data) for op, data in changes):
+            changed = {data['book_id'] for op, data in changes if op in ('create', 'update')}
+            books = booksBorrowedAlongside(changed) if changed else set()
+
+    neighbours = topNeighbours(borrowBatches(batch_size), books, current_app.config['RECOMMENDATIONS_TOP_K'])
+
+    if books is None:
+        db.session.execute(db.delete(BookSimilarity))
+    else:
+        bookIDs = sorted(books)
+        for start in range(0, len(bookIDs), 500):
+            db.session.execute(db.delete(BookSimilarity).where(BookSimilarity.book_id.in_(bookIDs[start:start + 500])))
+    rows = [
+        {'book_id': bookID, 'similar_book_id': similarID, 'score': score, 'co_borrowers': together}
+        for bookID, similar in neighbours.items()
+        for similarID, score, together in similar
+    ]
+    if rows:
+        db.session.execute(db.insert(BookSimilarity), rows)
+
+    state.last_seq = lastSeq
+    state.refreshed_at = datetime.utcnow()
+    db.session.add(state)
+    db.session.commit()
+    return len(neighbours) if books is None else len(books)
+
+@api.cli.command('refresh-recommendations')
+@click.option('--full', is_flag=True, help='Recompute every book, not only the ones touched by new loans.')
+@click.option('--batch-size', type=int, default=None, help='Loans read per batch (RECOMMENDATIONS_BATCH_SIZE).')
+def refreshRecommendationsCommand(full, batch_size):
+    started = time.perf_counter()
+    refreshed = refresh_recommendations(full, batch_size)
+    click.echo(f"Recommendations refreshed for {refreshed} books in {time.perf_counter() - started:.1f}s.")
+
+#------------------------------------------------
+# Snapshot export - compressed columnar files of every table for bulk consumers (see export.py)
+#------------------------------------------------
+
+# file name -> (model, change log entity, change log ops touching its rows, rows can disappear)
+EXPORT_SOURCES = {
+    'books': (Book, 'book', ('create', 'update', 'delete'), False),
+    'customers': (Customer, 'customer', ('create', 'update', 'delete'), False),
+    'loans': (Loan, 'loan', ('create', 'update', 'delete', 'archive'), True),
+    'archived_loans': (LoanArchive, 'loan', ('archive',), False),
+}
+
+EXPORT_MIMETYPES = {
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.file',
+    'csv': 'application/gzip',
+}
+
+# A full snapshot holds every row (soft deleted ones included), an incremental one the rows changed
+# since the previous snapshot (current values, to upsert) plus, for loans, a loans_deleted file with
+# the ids of the rows deleted or archived since. Rows are at least as recent as last_seq.
+#   files - JSON list of {"name", "table", "rows", "bytes"}
+class ExportSnapshot(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), unique=True, nullable=False)   # directory under EXPORT_DIR
+    kind = db.Column(db.String(16), nullable=False)                # full | incremental
+    format = db.Column(db.String(16), nullable=False)
+    since_seq = db.Column(db.Integer, nullable=True)               # last_seq of the previous snapshot (incremental)
+    last_seq = db.Column(db.Integer, nullable=False)               # change log position the snapshot covers
+    files = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+def exportDirectory(name=''):
+    return os.path.join(os.path.abspath(current_app.config['EXPORT_DIR']), name)
+
+# streams the rows of a statement into <directory>/<name><extension>, batch_size rows at a time
+def exportTable(directory, name, columns, statement, format, batch_size):
+    batches = db.session.execute(statement.execution_options(yield_per=batch_size)).partitions()
+    fileName, rows = write_table(os.path.join(directory, name), columns, batches, format)
+    return {'name': fileName, 'table': name, 'rows': rows, 'bytes': os.path.getsize(os.path.join(directory, fileName))}
+
+# Writes a snapshot of every EXPORT_SOURCES table. incremental=True only exports what changed since the
+# previous snapshot (from the change log) - a full one is taken instead when there is no previous
+# snapshot in that format, the change log was pruned past it or a bulk import (reload) happened since.
+def create_snapshot(incremental=False, format=None, batch_size=None):
+    format = format or current_app.config['EXPORT_FORMAT'] or default_format()
+    check_format(format)
+    batch_size = batch_size or current_app.config['EXPORT_BATCH_SIZE']
+
+    # read before the rows, so changes racing the export are exported (again) by the next snapshot
+    lastSeq = db.session.scalar(db.select(db.func.max(ChangeLog.seq))) or 0
+    since = None
+    if incremental:
+        previous = db.session.scalars(
+            db.select(ExportSnapshot).where(ExportSnapshot.format == format).order_by(ExportSnapshot.id.desc()).limit(1)).first()
+        if previous is not None and not changesPruned(previous.last_seq) and not db.session.scalar(
+                db.select(db.exists().where(ChangeLog.op == 'reload', ChangeLog.seq > previous.last_seq))):
+            since = previous.last_seq
+
+    createdAt = datetime.utcnow()
+    name = f"{createdAt:%Y%m%dT%H%M%S%f}-{lastSeq}"
+    # written under a temporary name and renamed once the snapshot is recorded - a failed export
+    # leaves no directory behind
+    directory = exportDirectory(name)
+    writing = directory + '.tmp'
+    os.makedirs(writing)
+    try:
+        files = []
+        for tableName, (model, entity, ops, rowsDisappear) in EXPORT_SOURCES.items():
+            columns = [(tableColumn.name, tableColumn.type.python_type) for tableColumn in model.__table__.columns]
+            statement = db.select(*model.__table__.columns).order_by(model.id)
+            if since is None:
+                files.append(exportTable(writing, tableName, columns, statement, format, batch_size))
+                continue
+
+            changedIDs = db.select(ChangeLog.entity_id).where(
+                ChangeLog.entity == entity, ChangeLog.op.in_(ops), ChangeLog.seq > since, ChangeLog.seq <= lastSeq)
+            files.append(exportTable(writing, tableName, columns, statement.where(model.id.in_(changedIDs)), format, batch_size))
+            if rowsDisappear:
+                deletedIDs = (db.select(ChangeLog.entity_id.label('id')).distinct()
+                              .where(ChangeLog.entity_id.in_(changedIDs), ~db.exists().where(model.id == ChangeLog.entity_id))
+                              .order_by(ChangeLog.entity_id))
+                files.append(exportTable(writing, tableName + '_deleted', [('id', int)], deletedIDs, format, batch_size))
+
+        db.session.commit()   # ends the read transaction before writing
+        snapshot = ExportSnapshot(name=name, kind='full' if since is None else 'incremental', format=format,
+                                  since_seq=since, last_seq=lastSeq, files=json.dumps(files), created_at=createdAt)
+        db.session.add(snapshot)
+        db.session.flush()
+        os.replace(writing, directory)
+        writing = directory
+        db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        shutil.rmtree(writing, ignore_errors=True)
+        raise
+    return snapshot
+
+@api.cli.command('export-snapshot')
+@click.option('--incremental', is_flag=True, help='Only the rows changed since the previous snapshot.')
+@click.option('--format', 'format', type=click.Choice(list(FORMATS)), default=None, help='EXPORT_FORMAT by default.')
+@click.option('--batch-size', type=int, default=None, help='Rows read & written per batch (EXPORT_BATCH_SIZE).')
+def exportSnapshotCommand(incremental, format, batch_size):
+    snapshot = create_snapshot(incremental, format, batch_size)
+    click.echo(f"{snapshot.kind.capitalize()} snapshot {snapshot.id} written to {exportDirectory(snapshot.name)}:")
+    for file in json.loads(snapshot.files):
+        click.echo(f"  {file['name']}: {file['rows']} rows, {file['bytes']} bytes")
+
 
 #------------------------------------------------
 # Unit Testing - initializing database using jsons
@@ -82,84 +945,192 @@ def clear_all_models():
     db.session.commit()
     print("All models/tables have been dropped.")
 
-# Function to load data from JSON file
-def load_json_data(file_path):
+# Incrementally parses a JSON array of records or NDJSON (one record per line) from a text stream,
+# holding only the current chunk in memory instead of the whole document
+def iter_json_records(text_stream, chunk_size=64 * 1024):
+    decoder = json.JSONDecoder()
+    buffer, position, eof = '', 0, False
+    in_array = None
+
+    while True:
+        # skip whitespace and, inside a top level array, the separating commas
+        while position < len(buffer) and (buffer[position].isspace() or (in_array and buffer[position] == ',')):
+            position += 1
+
+        if position == len(buffer):
+            if eof:
+                return
+            chunk = text_stream.read(chunk_size)
+            buffer, position, eof = chunk, 0, not chunk
+            continue
+
+        if in_array is None:
+            in_array = buffer[position] == '['
+            if in_array:
+                position += 1
+                continue
+
+        if in_array and buffer[position] == ']':
+            return
+
+        try:
+            record, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # record cut at the chunk boundary - read more and retry
+            if eof:
+                raise
+            chunk = text_stream.read(chunk_size)
+            buffer, position, eof = buffer[position:] + chunk, 0, not chunk
+            continue
+
+        yield record
+
+        # drop the consumed part of the buffer once it grows past a chunk
+        if position > chunk_size:
+            buffer, position = buffer[position:], 0
+
+# JSON record -> table row converters for the bulk import
+def bookRowFromRecord(record):
+    return {
+        'id': record['ID'] if 'ID' in record else record['id'],
+        'name': record['name'],
+        'author': record['author'],
+        'year_published': record.get('year_published'),
+        'type': record['type'],
+        'is_available': record.get('is_available', True),
+    }
+
+def customerRowFromRecord(record):
+    return {
+        'id': record['id'],
+        'name': record['name'],
+        'city': record.get('city'),
+        'age': record.get('age'),
+    }
+
+def loanRowFromRecord(record):
+    return {
+        'id': record['id'],
+        'customer_id': record['customer_id'],
+        'book_id': record['book_id'],
+        'loan_date': datetime.fromisoformat(record['loan_date']),
+        'return_date': datetime.fromisoformat(record['return_date']) if record.get('return_date') else None,
+        'due_date': None,  # recomputed by refresh_due_dates once the import is done
+    }
+
+# name -> (model, default mockup file, converter) for everything the bulk import understands
+IMPORT_SOURCES = {
+    'books': (Book, './mockup/books.json', bookRowFromRecord),
+    'customers': (Customer, './mockup/customers.json', customerRowFromRecord),
+    'loans': (Loan, './mockup/loans.json', loanRowFromRecord),
+}
+
+# insert() construct supporting ON CONFLICT for the bound engine
+def dialectInsert():
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+# columns an import always resets (to be recomputed afterwards) - not compared when diffing
+DERIVED_COLUMNS = {Loan: ('due_date',)}
+
+# INSERT ... ON CONFLICT (id) DO UPDATE for the given columns, in the dialect of the bound engine.
+# Rows identical to the stored one are left alone (no write, no trigger / index maintenance).
+def upsertStatement(model, columns):
+    statement = dialectInsert()(model.__table__)
+    compared = [name for name in columns if name != 'id' and name not in DERIVED_COLUMNS.get(model, ())]
+    return statement.on_conflict_do_update(
+        index_elements=['id'],
+        set_={name: statement.excluded[name] for name in columns if name != 'id'},
+        where=db.or_(*(model.__table__.c[name].is_distinct_from(statement.excluded[name]) for name in compared))
+    )
+
+# Bulk upsert of an iterable of JSON records into one of the IMPORT_SOURCES tables.
+# Rows are sent with executemany in chunks, each chunk committed on its own, and
+# progress(rows, seconds) is called after every chunk.
+def bulk_import(source, records, chunk_size=5000, progress=None):
+    model, _, toRow = IMPORT_SOURCES[source]
+    statement = None
+    started = time.perf_counter()
+    total = changed = 0
+    chunk = []
+
+    def flush():
+        nonlocal statement, total, changed
+        if statement is None:
+            statement = upsertStatement(model, chunk[0].keys())
+        changed += max(db.session.execute(statement, chunk).rowcount, 0)
+        db.session.commit()
+        total += len(chunk)
+        chunk.clear()
+        if progress:
+            progress(total, time.perf_counter() - started)
+
+    try:
+        for record in records:
+            chunk.append(toRow(record))
+            if len(chunk) >= chunk_size:
+                flush()
+        if chunk:
+            flush()
+    except Exception as e:
+        db.session.rollback()
+        raise ImportInterrupted(e, importStats(source, total, changed, started)) from e
+    finally:
+        # the chunks committed before an error stay imported - finish them as well
+        finishImport(source, changed)
+    return importStats(source, total, changed, started)
+
+# an import that failed after committing some chunks: they are kept, stats counts them
+class ImportInterrupted(Exception):
+    def __init__(self, error, stats):
+        super().__init__(str(error))
+        self.error = error
+        self.stats = stats
+
+def importStats(source, total, changed, started):
+    seconds = time.perf_counter() - started
+    return {
+        'source': source,
+        'rows': total,
+        'changed': changed,   # inserted or modified rows (0 when the driver doesn't report it)
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(total / seconds) if seconds else total,
+    }
+
+# after rows were imported into a table: change feed consumers resync it (too many rows to log one
+# by one), imported loans get their due date and the summary tables are rebuilt
+def finishImport(source, changed):
+    model = IMPORT_SOURCES[source][0]
+    if changed:
+        logChanges([(model.__table__.name, None, 'reload', None)])
+        db.session.commit()
+    if source == 'loans':
+        refresh_due_dates()
+        if current_app.config['REPORT_SUMMARIES']:
+            rebuild_loan_summaries()
+
+# bulk import of one of the mockup files
+def import_json_file(source, file_path=None, chunk_size=5000, progress=None):
+    file_path = file_path or IMPORT_SOURCES[source][1]
     with open(file_path, 'r') as json_file:
-        return json.load(json_file)
+        return bulk_import(source, iter_json_records(json_file), chunk_size, progress)
 
 # Function to update the Books table
 def update_books():
-    books_data = load_json_data('./mockup/books.json')  # Adjust path as needed
-
-    for book_data in books_data:
-        book = db.session.get(Book, book_data['ID'])
-        
-        if not book:
-            book = Book(
-                id=book_data['ID'],
-                name=book_data['name'],
-                author=book_data['author'],
-                year_published=book_data['year_published'],
-                type=book_data['type'],
-                is_available=book_data['is_available']
-            )
-            db.session.add(book)
-        else:
-            book.name = book_data['name']
-            book.author = book_data['author']
-            book.year_published = book_data['year_published']
-            book.type = book_data['type']
-            book.is_available = book_data['is_available']
-
-    db.session.commit()
+    import_json_file('books')
     print("Books table updated.")
 
 # Function to update the Customers table
 def update_customers():
-    customers_data = load_json_data('./mockup/customers.json')  # Adjust path as needed
-
-    for customer_data in customers_data:
-        customer = db.session.get(Customer, customer_data['id'])
-        
-        if not customer:
-            customer = Customer(
-                id=customer_data['id'],
-                name=customer_data['name'],
-                city=customer_data['city'],
-                age=customer_data['age']
-            )
-            db.session.add(customer)
-        else:
-            customer.name = customer_data['name']
-            customer.city = customer_data['city']
-            customer.age = customer_data['age']
-
-    db.session.commit()
+    import_json_file('customers')
     print("Customers table updated.")
 
 # Function to update the Loans table
 def update_loans():
-    loans_data = load_json_data('./mockup/loans.json')  # Adjust path as needed
-
-    for loan_data in loans_data:
-        loan = db.session.get(Loan, loan_data['id'])
-        
-        if not loan:
-            loan = Loan(
-                id=loan_data['id'],
-                customer_id=loan_data['customer_id'],
-                book_id=loan_data['book_id'],
-                loan_date=datetime.fromisoformat(loan_data['loan_date']),
-                return_date=datetime.fromisoformat(loan_data['return_date']) if loan_data['return_date'] else None
-            )
-            db.session.add(loan)
-        else:
-            loan.customer_id = loan_data['customer_id']
-            loan.book_id = loan_data['book_id']
-            loan.loan_date = datetime.fromisoformat(loan_data['loan_date'])
-            loan.return_date = datetime.fromisoformat(loan_data['return_date']) if loan_data['return_date'] else None
-
-    db.session.commit()
+    import_json_file('loans')
     print("Loans table updated.")
 
 # Main function to update all tables
@@ -173,25 +1144,249 @@ def create_tables():
     db.create_all()
     print("All tables created successfully.")
 
+# bulk import from the command line, e.g. flask --app app import-data loans ./dump.ndjson
+@api.cli.command('import-data')
+@click.argument('source', type=click.Choice(list(IMPORT_SOURCES)))
+@click.argument('file_path', required=False)
+@click.option('--chunk-size', default=5000, show_default=True, help='Rows per executemany/commit.')
+def importDataCommand(source, file_path, chunk_size):
+    def progress(rows, seconds):
+        click.echo(f"{source}: {rows} rows ({rows / seconds if seconds else rows:.0f} rows/s)")
+
+    try:
+        stats = import_json_file(source, file_path, chunk_size, progress)
+    except ImportInterrupted as e:
+        raise click.ClickException(f"{source}: {e} - {e.stats['rows']} rows were imported before the error.")
+    click.echo(f"{source}: imported {stats['rows']} rows in {stats['seconds']}s ({stats['rows_per_second']} rows/s)")
 
 #------------------------------------------------
-# ####### Rest Api #######
+# Schema migration & incremental seeding (run at deploy time: flask --app app init-db)
 #------------------------------------------------
 
-# initialize database
-@app.route('/initModels', methods = ['GET'])
-def modelsInit():
+# checksum of every mockup file already applied, unchanged files are skipped on the next run
+class SeedChecksum(db.Model):
+    __tablename__ = 'seed_checksum'
+    source = db.Column(db.String(50), primary_key=True)
+    sha256 = db.Column(db.String(64), nullable=False)
+    rows = db.Column(db.Integer, nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False)
+
+# hash of every seeded row as it was in its file: a row is only written again when its own record changed
+class SeedRow(db.Model):
+    __tablename__ = 'seed_row'
+    source = db.Column(db.String(50), primary_key=True)
+    row_id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), nullable=False)
+
+# live state the app maintains itself - seeded rows get it from their file when inserted, never after
+SEED_LIVE_COLUMNS = {Book: ('is_available',)}
+
+# indexes of older schemas made redundant by a wider one, by table
+SUPERSEDED_INDEXES = {
+    'loan': ('ix_loan_book_loan_date',),   # prefix of ix_loan_book_period
+}
+
+# Brings the schema of an existing database up to the models without touching the data:
+# creates the missing tables (with their indexes & triggers), adds the missing columns and
+# indexes of existing tables and drops the superseded indexes. Returns a description of every change.
+def migrate_schema():
+    inspector = inspect(db.engine)
+    existing = set(inspector.get_table_names())
+    quote = db.engine.dialect.identifier_preparer.quote
+    changes = []
+
+    missing = [table for table in db.metadata.sorted_tables if table.name not in existing]
+    db.metadata.create_all(db.engine, tables=missing)
+    changes += [f"created table {table.name}" for table in missing]
+
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing:
+                continue
+            columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for tableColumn in table.columns:
+                if tableColumn.name in columns:
+                    continue
+                if not tableColumn.nullable:
+                    raise RuntimeError(f"Can't add the NOT NULL column {table.name}.{tableColumn.name} to existing rows, migrate it by hand.")
+                columnType = tableColumn.type.compile(dialect=db.engine.dialect)
+                connection.execute(db.text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(tableColumn.name)} {columnType}"))
+                changes.append(f"added column {table.name}.{tableColumn.name}")
+
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+                    changes.append(f"created index {index.name}")
+            for name in SUPERSEDED_INDEXES.get(table.name, ()):
+                if name in indexes:
+                    connection.execute(db.text(f"DROP INDEX {quote(name)}"))
+                    changes.append(f"dropped index {name}")
+
+    # the full-text index is created with the book table, add it to older databases
+    if db.engine.dialect.name == 'sqlite' and 'book' in existing and 'book_fts' not in existing:
+        rebuild_book_search_index()
+        changes.append("created table book_fts")
+    return changes
+
+def fileChecksum(file_path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as source_file:
+        for chunk in iter(lambda: source_file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def recordChecksum(record):
+    return hashlib.sha256(json.dumps(record, sort_keys=True, default=str).encode()).hexdigest()
+
+# Applies one mockup file, chunk_size records per transaction: rows never seeded are inserted (unless a
+# row with that id exists already), seeded rows are updated only when their own record changed since -
+# except their SEED_LIVE_COLUMNS - and everything else is left alone, so edits made through the API
+# and rows deleted since survive a change elsewhere in the file.
+def seed_source(source, file_path, chunk_size=5000, progress=None):
+    model, _, toRow = IMPORT_SOURCES[source]
+    started = time.perf_counter()
+    total = changed = 0
+    chunk = []
+
+    def flush():
+        nonlocal total, changed
+        rows = [(toRow(record), recordChecksum(record)) for record in chunk]
+        checksums = {row['id']: (row, checksum) for row, checksum in rows}
+        seeded = dict(db.session.execute(
+            db.select(SeedRow.row_id, SeedRow.sha256).where(SeedRow.source == source, SeedRow.row_id.in_(checksums))
+        ).all())
+        inserts = [row for rowID, (row, _) in checksums.items() if rowID not in seeded]
+        updates = [row for rowID, (row, checksum) in checksums.items() if rowID in seeded and seeded[rowID] != checksum]
+        if inserts:
+            changed += max(db.session.execute(dialectInsert()(model.__table__).on_conflict_do_nothing(index_elements=['id']), inserts).rowcount, 0)
+        if updates:
+            columns = [name for name in updates[0] if name != 'id' and name not in SEED_LIVE_COLUMNS.get(model, ())]
+            statement = (db.update(model.__table__).where(model.__table__.c.id == db.bindparam('row_id'))
+                         .values({name: db.bindparam(name) for name in columns}))
+            # only the bound columns: any other key named like a column would be SET as well
+            parameters = [dict({name: row[name] for name in columns}, row_id=row['id']) for row in updates]
+            changed += max(db.session.execute(statement, parameters).rowcount, 0)
+        if inserts or updates:
+            statement = dialectInsert()(SeedRow.__table__)
+            db.session.execute(statement.on_conflict_do_update(index_elements=['source', 'row_id'], set_={'sha256': statement.excluded.sha256}), [
+                {'source': source, 'row_id': rowID, 'sha256': checksum}
+                for rowID, (_, checksum) in checksums.items() if seeded.get(rowID) != checksum
+            ])
+        db.session.commit()
+        total += len(chunk)
+        chunk.clear()
+        if progress:
+            progress(total, time.perf_counter() - started)
+
+    try:
+        with open(file_path, 'r') as json_file:
+            for record in iter_json_records(json_file):
+                chunk.append(record)
+                if len(chunk) >= chunk_size:
+                    flush()
+            if chunk:
+                flush()
+    except Exception as e:
+        db.session.rollback()
+        raise ImportInterrupted(e, importStats(source, total, changed, started)) from e
+    finally:
+        finishImport(source, changed)
+    return importStats(source, total, changed, started)
+
+# Applies the mockup files whose content changed since they were last applied (see seed_source for
+# which rows are written). force=True re-reads every file.
+def seed_database(force=False, progress=None):
+    results = []
+    for source, (_, file_path, _) in IMPORT_SOURCES.items():
+        checksum = fileChecksum(file_path)
+        applied = db.session.get(SeedChecksum, source)
+        if applied is not None and applied.sha256 == checksum and not force:
+            results.append({'source': source, 'skipped': True})
+            continue
+
+        stats = seed_source(source, file_path, progress=progress)
+        db.session.merge(SeedChecksum(source=source, sha256=checksum, rows=stats['rows'], applied_at=datetime.utcnow()))
+        db.session.commit()
+        results.append(stats)
+    return results
+
+# migrate the schema & seed the mockup data, safe to run on every deploy
+@api.cli.command('init-db')
+@click.option('--no-seed', is_flag=True, help='Only migrate the schema.')
+@click.option('--force-seed', is_flag=True, help='Re-read every mockup file, even unchanged ones.')
+def initDbCommand(no_seed, force_seed):
+    changes = migrate_schema()
+    for change in changes:
+        click.echo(change)
+    if not changes:
+        click.echo("Schema is up to date.")
+    if no_seed:
+        return
+    for stats in seed_database(force=force_seed):
+        if stats.get('skipped'):
+            click.echo(f"{stats['source']}: unchanged, skipped")
+        else:
+            click.echo(f"{stats['source']}: {stats['changed']} of {stats['rows']} rows written in {stats['seconds']}s")
+
+# drops every table and reloads the mockup data (the former /initModels) - development only
+@api.cli.command('reset-db')
+@click.confirmation_option(prompt='This drops every table and its data. Continue?')
+def resetDbCommand():
     clear_all_models()
     create_tables()
     update_all_tables()
-    return "tables updated"
+
+
+#------------------------------------------------
+# ####### Rest Api #######
+#------------------------------------------------
+
+# admin routes need "Authorization: Bearer <ADMIN_TOKEN>" - and are disabled while no token is configured
+def adminRequired(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = current_app.config['ADMIN_TOKEN']
+        if not token:
+            return jsonify({"error": "Admin routes are disabled, set LIBRARY_ADMIN_TOKEN to enable them."}), 403
+        scheme, _, given = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not hmac.compare_digest(given.encode(), token.encode()):
+            return jsonify({"error": "Admin token required."}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+# bulk import of a JSON array / NDJSON request body, streamed straight from the socket
+#   /admin/import/books|customers|loans?chunk_size=<n>
+@api.route('/admin/import/<source>', methods=['POST'])
+@adminRequired
+def adminImport(source):
+    try:
+        if source not in IMPORT_SOURCES:
+            return jsonify({"error": f"Unknown import source {source}. Use one of {', '.join(IMPORT_SOURCES)}."}), 404
+
+        chunkSize = max(1, request.args.get('chunk_size', 5000, type=int))
+        body = io.TextIOWrapper(request.stream, encoding='utf-8')
+        stats = bulk_import(source, iter_json_records(body), chunkSize)
+
+        return jsonify({'message': 'successful import', **stats}), 200
+
+    except ImportInterrupted as e:
+        # the chunks committed before the error are kept, tell how far the import got
+        if isinstance(e.error, (ValueError, KeyError)):
+            return jsonify({"error": f"Invalid import data: {str(e)}", 'committed': e.stats}), 400
+        return jsonify({'message': 'error', 'error': str(e), 'committed': e.stats}), 500
+    except Exception as e:
+        return jsonify({
+            'message': 'error',
+            'error': str(e)
+        }), 500
 
 #------------------------------------------------
 # Item Addition 
 #------------------------------------------------
 
 # add a book
-@app.route('/createBook', methods = ['POST'])
+@api.route('/createBook', methods = ['POST'])
 def createBook():
     try:
         data = request.get_json()
@@ -217,14 +1412,7 @@ def createBook():
         
         return jsonify({
                 'message': 'successful book addition',
-                'book':
-                {
-                    'id':new_customer.id,
-                    'name':new_customer.name,
-                    'author':new_customer.author,
-                    'year_published':new_customer.year_published,
-                    'type':new_customer.type
-                }}), 201
+                'book': bookToDict(new_customer)}), 201
     except Exception as e:
         jsonify({
             'message': 'error',
@@ -232,7 +1420,7 @@ def createBook():
         }), 500
 
 # add a customer
-@app.route('/createCustomer', methods = ['POST'])
+@api.route('/createCustomer', methods = ['POST'])
 def createCustomer():
     try:
         data = request.get_json()
@@ -255,13 +1443,7 @@ def createCustomer():
         
         return jsonify({
                 'message': 'successful customer addition',
-                'customer':
-                {
-                    'id':new_customer.id,
-                    'name':new_customer.name,
-                    'city':new_customer.city,
-                    'age':new_customer.age,
-                }}), 201
+                'customer': customerToDict(new_customer)}), 201
     except Exception as e:
         jsonify({
             'message': 'error',
@@ -269,7 +1451,7 @@ def createCustomer():
         }), 500
 
 # add loan
-@app.route('/createLoan', methods = ['POST'])
+@api.route('/createLoan', methods = ['POST'])
 def createLoan():
     try:    
         data = request.get_json()
@@ -277,9 +1459,18 @@ def createLoan():
         customerID = data.get('customer_id')
         bookID = data.get('book_id')
         loanDate = datetime.strptime(data.get('loan_date'), "%Y-%m-%d %H:%M")
-        returnDate = datetime.strptime(data.get('return_date'), "%Y-%m-%d %H:%M")
+        returnDate = datetime.strptime(data.get('return_date'), "%Y-%m-%d %H:%M") if data.get('return_date') else None
+
+        validationError = loanValidationHelper(customerID, bookID, loanDate, returnDate)
+        if validationError:
+            return jsonify(validationError[0]), validationError[1]
 
-        loanValidationHelper(customerID, bookID, loanDate, returnDate)
+        # a loan that is running now takes the copy off the shelf - claimed atomically so it can't be lent twice.
+        # Future loans are reservations, the booking check keeps them from overlapping other loans.
+        now = datetime.utcnow()
+        if loanDate <= now and (returnDate is None or returnDate > now):
+            if not claimBook(bookID):
+                return jsonify({"error": f"Book with ID {bookID} is not available."}), 409
 
         new_loan = Loan(
             customer_id = customerID,
@@ -293,57 +1484,392 @@ def createLoan():
 
         return jsonify({
                     'message': 'successful loan addition',
-                    'Loan':
-                    {
-                        'id': new_loan.id,
-                        'customer_id':new_loan.customer_id,
-                        'book_id':new_loan.book_id,
-                        'loan_date':new_loan.loan_date,
-                        'return_date':new_loan.return_date,
-                    }}), 201
+                    'Loan': loanToDict(new_loan)}), 201
+    except BookingConflict as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 409
     except Exception as e:
-        jsonify({
+        db.session.rollback()
+        return jsonify({
             'message': 'error',
-            'error': e,
+            'error': str(e),
         }), 500
 
+#------------------------------------------------
+# Checkout & Return
+#------------------------------------------------
+
+# lend a book: a single conditional UPDATE claims the copy (only if it is available and the
+# customer exists) and the loan is inserted in the same transaction
+@api.route('/checkoutBook', methods=['POST'])
+def checkoutBook():
+    try:
+        data = request.get_json()
+
+        customerID = data.get('customer_id')
+        bookID = data.get('book_id')
+        try:
+            loanDate = datetime.fromisoformat(data['loan_date']) if data.get('loan_date') else datetime.utcnow()
+        except ValueError:
+            return jsonify({"error": "Invalid format for loan_date. Use ISO format (YYYY-MM-DDTHH:MM:SS)"}), 400
+
+        if customerID is None or bookID is None:
+            return jsonify({"error": "Invalid input. customer_id and book_id are required."}), 400
+
+        if not claimBook(bookID, customerID):
+            # cold path - find out why the claim failed
+            db.session.rollback()
+            if not getActive(Customer, customerID):
+                return jsonify({"error": f"Customer with ID {customerID} does not exist."}), 404
+            if not getActive(Book, bookID):
+                return jsonify({"error": f"Book with ID {bookID} does not exist."}), 404
+            return jsonify({"error": f"Book with ID {bookID} is not available."}), 409
+
+        new_loan = Loan(customer_id=customerID, book_id=bookID, loan_date=loanDate)
+        db.session.add(new_loan)
+        db.session.commit()
+
+        return jsonify({
+            'message': 'successful checkout',
+            'loan': loanToDict(new_loan)
+        }), 201
+
+    except BookingConflict as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 409
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'message': 'error',
+            'error': str(e)
+        }), 500
+
+# return a lent book: closes the open loan and puts the copy back on the shelf in one transaction
+@api.route('/returnBook/<int:loan_id>', methods=['POST'])
+def returnBook(loan_id):
+    try:
+        data = request.get_json(silent=True) or {}
+        try:
+            returnDate = datetime.fromisoformat(data['return_date']) if data.get('return_date') else datetime.utcnow()
+        except ValueError:
+            return jsonify({"error": "Invalid format for return_date. Use ISO format (YYYY-MM-DDTHH:MM:SS)"}), 400
+
+        # only an open loan can be returned - the condition makes concurrent returns safe
+        returned = db.session.execute(
+            db.update(Loan)
+            .where(Loan.id == loan_id, loanIsOpen(returnDate), Loan.loan_date < returnDate)
+            .values(return_date=returnDate)
+            .returning(*columnsFor(Loan, LOAN_FIELDS))
+            .execution_options(synchronize_session=False, loan_books_tracked=True)
+        ).first()
+
+        if returned is None:
+            db.session.rollback()
+            loan = db.session.get(Loan, loan_id)
+            if not loan:
+                return jsonify({"error": "Loan not found."}), 404
+            if loan.loan_date >= returnDate:
+                return jsonify({"error": "Loan date must be before the return date."}), 400
+            # a loan that ran out on its own may still hold the copy - put it back on the shelf
+            if releaseEndedClaim(loan.book_id):
+                db.session.commit()
+                return jsonify({
+                    'message': f'Loan with ID {loan_id} was already returned, the book is available again.',
+                    'loan': loanToDict(loan)
+                }), 200
+            return jsonify({"error": f"Loan with ID {loan_id} was already returned."}), 409
+
+        logReturnedRows(Loan, [returned])
+        touchBookLoans([returned.book_id])
+        releaseBook(returned.book_id)
+        db.session.commit()
+
+        return jsonify({
+            'message': 'successful return',
+            'loan': rowToDict(returned, LOAN_FIELDS)
+        }), 200
+
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'message': 'error',
+            'error': str(e)
+        }), 500
+
+#------------------------------------------------
+# Book availability
+#------------------------------------------------
+
+# booked & free periods of a book, from its interval index (bookIntervals)
+#   ?from=<ISO date>  - start of the window (default now)
+#   ?to=<ISO date>    - end of the window (default 30 days after from)
+@api.route('/books/<int:book_id>/availability', methods=['GET'])
+@rateLimited('list')
+def bookAvailability(book_id):
+    try:
+        start, end = availabilityWindow(request.args)
+        if not getActive(Book, book_id):
+            return jsonify({"error": "Book not found."}), 404
+
+        index = bookIntervals(book_id)
+        return jsonify({
+            'book_id': book_id,
+            'from': start,
+            'to': end,
+            'available': not index.overlaps(start, end),
+            'booked': [{'loan_id': loanID, 'from': bookedFrom, 'to': bookedTo} for bookedFrom, bookedTo, loanID in index.overlapping(start, end)],
+            'free': [{'from': freeFrom, 'to': freeTo} for freeFrom, freeTo in index.gaps(start, end)],
+        }), 200
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({
+            'message': 'error',
+            'error': str(e)
+        }), 500
+
+#------------------------------------------------
+# Overdue loans
+#------------------------------------------------
+
+# open loans past their due date with book & customer details, one joined query over ix_loan_due_date
+#   ?customer_id=<id> ?limit=<n>&after=<id> ?stream=1 - like the list endpoints
+@api.route('/overdueLoans', methods=['GET'])
+@rateLimited('list')
+def overdueLoans():
+    try:
+        now = datetime.utcnow()
+        query = (db.select(
+                    Loan.id, Loan.customer_id, Loan.book_id, Loan.loan_date, Loan.due_date,
+                    Book.name.label('book_name'), Book.type.label('book_type'),
+                    Customer.name.label('customer_name'))
+                 .join(Book, Book.id == Loan.book_id)
+                 .join(Customer, Customer.id == Loan.customer_id)
+                 .where(loanIsOverdue(now)))
+        customerID = parseIntArg(request.args, 'customer_id')
+        if customerID is not None:
+            query = query.where(Loan.customer_id == customerID)
+
+        def overdueLoanToDict(row):
+            return {
+                'id': row.id,
+                'customer_id': row.customer_id,
+                'customer_name': row.customer_name,
+                'book_id': row.book_id,
+                'book_name': row.book_name,
+                'loan_type': LoanType(row.book_type).name,
+                'loan_date': row.loan_date,
+                'due_date': row.due_date,
+                'days_overdue': (now - row.due_date).days,
+            }
+
+        return listResponse(query, Loan, overdueLoanToDict)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({
+            'message': 'error',
+            'error': str(e)
+        }), 500
+
+# number of overdue loans and oldest due date per customer, aggregated in SQL
+#   ?customer_id=<id> - summary of a single customer
+@api.route('/overdueSummary', methods=['GET'])
+@rateLimited('list')
+def overdueSummary():
+    try:
+        query = (db.session.query(
+                    Customer.id, Customer.name,
+                    db.func.count(Loan.id).label('overdue_loans'),
+                    db.func.min(Loan.due_date).label('oldest_due_date'))
+                 .join(Loan, Loan.customer_id == Customer.id)
+                 .filter(loanIsOverdue())
+                 .group_by(Customer.id, Customer.name)
+                 .order_by(db.func.count(Loan.id).desc(), Customer.id))
+        customerID = parseIntArg(request.args, 'customer_id')
+        if customerID is not None:
+            query = query.filter(Loan.customer_id == customerID)
+
+        return jsonify([{
+            'customer_id': row.id,
+            'customer_name': row.name,
+            'overdue_loans': row.overdue_loans,
+            'oldest_due_date': row.oldest_due_date,
+        } for row in query.all()]), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({
+            'message': 'error',
+            'error': str(e)
+        }), 500
+
+#------------------------------------------------
+# Reports
+#------------------------------------------------
+
+# Circulation statistics aggregated in SQL over the live & archived loans. With REPORT_SUMMARIES on, the
+# per book / customer / city / month / author reports read the precomputed summary tables instead of
+# grouping the loan tables.
+#   ?limit=<n> - number of rows of the ranking reports (default 100, capped by LIST_MAX_LIMIT)
+
+def reportLimit():
+    limit = parseIntArg(request.args, 'limit')
+    return max(1, min(100 if limit is None else limit, current_app.config['LIST_MAX_LIMIT']))
+
+# loans per book: (book_id, loan_count) rows as a subquery, from the summary table or grouped live
+def loansPerBookSubquery():
+    if current_app.config['REPORT_SUMMARIES']:
+        return db.select(BookLoanStats.book_id, BookLoanStats.loan_count).where(BookLoanStats.loan_count > 0).subquery()
+    loans = allLoansSubquery()
+    return db.select(loans.c.book_id, db.func.count().label('loan_count')).group_by(loans.c.book_id).subquery()
+
+def loansPerCustomerSubquery():
+    if current_app.config['REPORT_SUMMARIES']:
+        return db.select(CustomerLoanStats.customer_id, CustomerLoanStats.loan_count).where(CustomerLoanStats.loan_count > 0).subquery()
+    loans = allLoansSubquery()
+    return db.select(loans.c.customer_id, db.func.count().label('loan_count')).group_by(loans.c.customer_id).subquery()
+
+# buildStatement() runs inside the error handling - it validates the query parameters (reportLimit)
+def reportResponse(buildStatement, toDict):
+    try:
+        return jsonify([toDict(row) for row in db.session.execute(buildStatement())]), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({
+            'message': 'error',
+            'error': str(e)
+        }), 500
+
+@api.route('/reports/loansPerBook', methods=['GET'])
+@rateLimited('report')
+@cachedResponse('loan', 'loan_archive', 'book', 'book_loan_stats')
+def reportLoansPerBook():
+    def build():
+        counts = loansPerBookSubquery()
+        statement = (db.select(Book.id, Book.name, Book.author, counts.c.loan_count)
+                     .join(counts, counts.c.book_id == Book.id)
+                     .order_by(counts.c.loan_count.desc(), Book.id)
+                     .limit(reportLimit()))
+        return statement
+    return reportResponse(build, lambda row: {
+        'book_id': row.id, 'name': row.name, 'author': row.author, 'loans': row.loan_count})
+
+@api.route('/reports/loansPerCustomer', methods=['GET'])
+@rateLimited('report')
+@cachedResponse('loan', 'loan_archive', 'customer', 'customer_loan_stats')
+def reportLoansPerCustomer():
+    def build():
+        counts = loansPerCustomerSubquery()
+        statement = (db.select(Customer.id, Customer.name, Customer.city, counts.c.loan_count)
+                     .join(counts, counts.c.customer_id == Customer.id)
+                     .order_by(counts.c.loan_count.desc(), Customer.id)
+                     .limit(reportLimit()))
+        return statement
+    return reportResponse(build, lambda row: {
+        'customer_id': row.id, 'name': row.name, 'city': row.city, 'loans': row.loan_count})
+
+@api.route('/reports/loansPerCity', methods=['GET'])
+@rateLimited('report')
+@cachedResponse('loan', 'loan_archive', 'customer', 'customer_loan_stats')
+def reportLoansPerCity():
+    def build():
+        counts = loansPerCustomerSubquery()
+        total = db.func.sum(counts.c.loan_count)
+        statement = (db.select(Customer.city, total.label('loans'))
+                     .join(counts, counts.c.customer_id == Customer.id)
+                     .group_by(Customer.city)
+                     .order_by(total.desc(), Customer.city)
+                     .limit(reportLimit()))
+        return statement
+    return reportResponse(build, lambda row: {'city': row.city, 'loans': row.loans})
+
+@api.route('/reports/loansPerMonth', methods=['GET'])
+@rateLimited('report')
+@cachedResponse('loan', 'loan_archive', 'monthly_loan_stats')
+def reportLoansPerMonth():
+    def build():
+        if current_app.config['REPORT_SUMMARIES']:
+            statement = (db.select(MonthlyLoanStats.month, MonthlyLoanStats.loan_count.label('loans'))
+                         .where(MonthlyLoanStats.loan_count > 0)
+                         .order_by(MonthlyLoanStats.month))
+        else:
+            month = monthExpression(allLoansSubquery().c.loan_date).label('month')
+            statement = db.select(month, db.func.count().label('loans')).group_by(month).order_by(month)
+        return statement
+    return reportResponse(build, lambda row: {'month': row.month, 'loans': row.loans})
+
+@api.route('/reports/topAuthors', methods=['GET'])
+@rateLimited('report')
+@cachedResponse('loan', 'loan_archive', 'book', 'book_loan_stats')
+def reportTopAuthors():
+    def build():
+        counts = loansPerBookSubquery()
+        total = db.func.sum(counts.c.loan_count)
+        statement = (db.select(Book.author, db.func.count(Book.id).label('books'), total.label('loans'))
+                     .join(counts, counts.c.book_id == Book.id)
+                     .group_by(Book.author)
+                     .order_by(total.desc(), Book.author)
+                     .limit(reportLimit()))
+        return statement
+    return reportResponse(build, lambda row: {'author': row.author, 'books': row.books, 'loans': row.loans})
+
+# share of the books of each LoanType currently lent out, plus their total loans
+@api.route('/reports/utilizationByType', methods=['GET'])
+@rateLimited('report')
+@cachedResponse('loan', 'loan_archive', 'book', 'book_loan_stats')
+def reportUtilizationByType():
+    def build():
+        counts = loansPerBookSubquery()
+        statement = (db.select(
+                        Book.type,
+                        db.func.count(Book.id).label('books'),
+                        db.func.sum(db.case((Book.is_available == False, 1), else_=0)).label('on_loan'),
+                        db.func.coalesce(db.func.sum(counts.c.loan_count), 0).label('loans'))
+                     .outerjoin(counts, counts.c.book_id == Book.id)
+                     .group_by(Book.type)
+                     .order_by(Book.type))
+        return statement
+    return reportResponse(build, lambda row: {
+        'type': row.type,
+        'loan_type': LoanType(row.type).name,
+        'loan_period_days': LOAN_PERIOD_DAYS[row.type],
+        'books': row.books,
+        'on_loan': row.on_loan,
+        'utilization': round(row.on_loan / row.books, 4) if row.books else 0.0,
+        'loans': row.loans,
+    })
+
 #------------------------------------------------
 # Show Items list
 #------------------------------------------------
 
 # show all books
-@app.route('/listBooks', methods=['GET'])
+@api.route('/listBooks', methods=['GET'])
+@rateLimited('list')
+@cachedResponse('book')
 def listBooks():
     try:
-        books = Book.query.all()
-        booksDictionary = [{
-            'id' : book.id,
-            'name' : book.name,
-            'author' : book.author, 
-            'year_published' : book.year_published,
-            'type' : book.type,
-            'is_available' : book.is_available
-        } for book in books]
-        return jsonify(booksDictionary), 200
+        return listResponse(*listBooksQuery(request.args))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        jsonify({
+        return jsonify({
             'message': 'error',
-            'error': e,
+            'error': str(e)
         }), 500
 
 # show all customers
-@app.route('/listCustomers', methods=['GET'])
+@api.route('/listCustomers', methods=['GET'])
+@rateLimited('list')
+@cachedResponse('customer')
 def listCustomers():
     try:
-        customers = Customer.query.all()
-        customersDictionary = [{
-            'id': customer.id,
-            'name': customer.name,
-            'city': customer.city,
-            'age': customer.age
-        } for customer in customers]
-        
-        return jsonify(customersDictionary), 200
+        return listResponse(*listCustomersQuery(request.args))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
     except Exception as e:
         return jsonify({
@@ -352,19 +1878,14 @@ def listCustomers():
         }), 500
 
 # show all loans
-@app.route('/listLoans', methods=['GET'])
+@api.route('/listLoans', methods=['GET'])
+@rateLimited('list')
+@cachedResponse('loan', 'book', 'customer')
 def listLoans():
     try:
-        loans = Loan.query.all()
-        loansDictionary = [{
-            'id': loan.id,
-            'customer_id':loan.customer_id,
-            'book_id':loan.book_id,
-            'loan_date':loan.loan_date,
-            'return_date':loan.return_date,
-        } for loan in loans]
-        
-        return jsonify(loansDictionary), 200
+        return listResponse(*listLoansQuery(request.args))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
     except Exception as e:
         return jsonify({
@@ -372,16 +1893,227 @@ def listLoans():
             'error': str(e)  # Convert the error to a string
         }), 500
 
+# loans moved out of the hot table by archive-loans, same filters & pagination as /listLoans
+# (customer_id, book_id, from, to - every archived loan is returned)
+@api.route('/archivedLoans', methods=['GET'])
+@rateLimited('list')
+@cachedResponse('loan_archive')
+def listArchivedLoans():
+    try:
+        return listResponse(*archivedLoansQuery(request.args))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({
+            'message': 'error',
+            'error': str(e)
+        }), 500
+
+#------------------------------------------------
+# Item details
+#------------------------------------------------
+
+# a book with its full loan history (and the borrowing customers) - 2 queries whatever the history size
+@api.route('/books/<int:book_id>', methods=['GET'])
+@cachedResponse('book', 'loan', 'customer')
+def bookDetails(book_id):
+    try:
+        book = (Book.query
+                .options(selectinload(Book.loans).joinedload(Loan.customer))
+                .filter(Book.id == book_id, notDeleted(Book))
+                .first())
+        if not book:
+            return jsonify({"error": "Book not found."}), 404
+
+        bookDictionary = bookToDict(book)
+        bookDictionary['loans'] = [
+            dict(loanToDict(loan), customer=customerToDict(loan.customer))
+            for loan in sorted(book.loans, key=lambda loan: loan.loan_date, reverse=True)
+        ]
+        return jsonify(bookDictionary), 200
+
+    except Exception as e:
+        return jsonify({
+            'message': 'error',
+            'error': str(e)
+        }), 500
+
+# a customer with the loans still open (and their books) - 2 queries whatever the number of loans
+@api.route('/customers/<int:customer_id>', methods=['GET'])
+@cachedResponse('customer', 'loan', 'book')
+def customerDetails(customer_id):
+    try:
+        customer = (Customer.query
+                    .options(selectinload(Customer.loans.and_(loanIsOpen())).joinedload(Loan.book))
+                    .filter(Customer.id == customer_id, notDeleted(Customer))
+                    .first())
+        if not customer:
+            return jsonify({"error": "Customer not found."}), 404
+
+        customerDictionary = customerToDict(customer)
+        customerDictionary['active_loans'] = [
+            dict(loanToDict(loan), book=bookToDict(loan.book))
+            for loan in sorted(customer.loans, key=lambda loan: loan.loan_date, reverse=True)
+        ]
+        return jsonify(customerDictionary), 200
+
+    except Exception as e:
+        return jsonify({
+            'message': 'error',
+            'error': str(e)
+        }), 500
+
+#------------------------------------------------
+# Recommendations - served from the precomputed BookSimilarity table (flask --app app refresh-recommendations)
+#   ?limit=<n> - number of books (default 10)
+#------------------------------------------------
+
+# books borrowed by the same customers as this one, most similar first
+@api.route('/books/<int:book_id>/similar', methods=['GET'])
+@rateLimited('list')
+@cachedResponse('book_similarity', 'book')
+def similarBooks(book_id):
+    try:
+        if not getActive(Book, book_id):
+            return jsonify({"error": "Book not found."}), 404
+
+        rows = db.session.execute(
+            db.select(*columnsFor(Book, BOOK_FIELDS), BookSimilarity.score, BookSimilarity.co_borrowers)
+            .join(BookSimilarity, BookSimilarity.similar_book_id == Book.id)
+            .where(BookSimilarity.book_id == book_id, notDeleted(Book))
+            .order_by(BookSimilarity.score.desc(), Book.id)
+            .limit(recommendationLimit())
+        ).all()
+        return jsonify([dict(rowToDict(row, BOOK_FIELDS), score=row.score, co_borrowers=row.co_borrowers) for row in rows]), 200
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({
+            'message': 'error',
+            'error': str(e)
+        }), 500
+
+# books the customer hasn't borrowed yet, ranked by their summed similarity to the ones they did
+@api.route('/customers/<int:customer_id>/recommendations', methods=['GET'])
+@rateLimited('list')
+@cachedResponse('book_similarity', 'book', 'customer', 'loan', 'loan_archive')
+def customerRecommendations(customer_id):
+    try:
+        if not getActive(Customer, customer_id):
+            return jsonify({"error": "Customer not found."}), 404
+
+        borrowed = db.union(
+            db.select(Loan.book_id).where(Loan.customer_id == customer_id),
+            db.select(LoanArchive.book_id).where(LoanArchive.customer_id == customer_id),
+        )
+        candidates = (
+            db.select(BookSimilarity.similar_book_id.label('book_id'), db.func.sum(BookSimilarity.score).label('score'))
+            .where(BookSimilarity.book_id.in_(borrowed), BookSimilarity.similar_book_id.not_in(borrowed))
+            .group_by(BookSimilarity.similar_book_id)
+            .subquery()
+        )
+        rows = db.session.execute(
+            db.select(*columnsFor(Book, BOOK_FIELDS), candidates.c.score)
+            .join(candidates, candidates.c.book_id == Book.id)
+            .where(notDeleted(Book))
+            .order_by(candidates.c.score.desc(), Book.id)
+            .limit(recommendationLimit())
+        ).all()
+        return jsonify([dict(rowToDict(row, BOOK_FIELDS), score=row.score) for row in rows]), 200
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({
+            'message': 'error',
+            'error': str(e)
+        }), 500
+
+#------------------------------------------------
+# Snapshot export - bulk consumers download files instead of paging through the list routes
+#------------------------------------------------
+
+# snapshots, newest first, with the URL of every file
+#   ?limit=<n> - number of snapshots (default 100)
+@api.route('/export', methods=['GET'])
+def listExports():
+    try:
+        snapshots = db.session.scalars(db.select(ExportSnapshot).order_by(ExportSnapshot.id.desc()).limit(reportLimit()))
+        return jsonify([snapshotToDict(snapshot) for snapshot in snapshots]), 200
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({
+            'message': 'error',
+            'error': str(e)
+        }), 500
+
+# takes a snapshot now - {"incremental": true, "format": "parquet" | "arrow" | "csv"}, both optional
+# (large databases: prefer flask --app app export-snapshot from cron, the request lasts as long as the export)
+@api.route('/export', methods=['POST'])
+@adminRequired
+def createExport():
+    try:
+        data = request.get_json(silent=True) or {}
+        snapshot = create_snapshot(bool(data.get('incremental')), data.get('format'))
+        return jsonify(snapshotToDict(snapshot)), 201
+
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'message': 'error',
+            'error': str(e)
+        }), 500
+
+# a file of a snapshot - Range / If-Range, ETag & If-None-Match are handled by send_from_directory
+# (files never change once written)
+@api.route('/export/<int:snapshot_id>/<file_name>', methods=['GET'])
+def exportFile(snapshot_id, file_name):
+    snapshot = db.session.get(ExportSnapshot, snapshot_id)
+    if snapshot is None or file_name not in {file['name'] for file in json.loads(snapshot.files)}:
+        return jsonify({"error": "Export file not found."}), 404
+    return send_from_directory(exportDirectory(snapshot.name), file_name, mimetype=EXPORT_MIMETYPES[snapshot.format],
+                               as_attachment=True, max_age=86400)
+
+#------------------------------------------------
+# Search
+#------------------------------------------------
+
+# ranked full-text search over book name & author
+#   ?q=<terms>            - every term must match as a word prefix ("harr pot" matches "Harry Potter")
+#   ?limit=<n>&offset=<n> - pagination (limit capped by LIST_MAX_LIMIT)
+@api.route('/searchBooks', methods=['GET'])
+@rateLimited('list')
+@cachedResponse('book')
+def searchBooks():
+    try:
+        statement = searchBooksQuery(request.args, db.engine.dialect.name)
+        results = [bookSearchResultToDict(row) for row in db.session.execute(statement)]
+        return jsonify(results), 200
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({
+            'message': 'error',
+            'error': str(e)
+        }), 500
+
 #------------------------------------------------
 # Update Item
 #------------------------------------------------
 
 # Update a book by ID
-@app.route('/updateBook/<int:id>', methods=['PUT'])
+@api.route('/updateBook/<int:id>', methods=['PUT'])
 def updateBook(id):
     try:
         # Fetch the book by ID
-        book = db.session.get(Book, id)
+        book = getActive(Book, id)
         
         if not book:
             return jsonify({"error": f"Book with ID {id} not found"}), 404
@@ -414,14 +2146,7 @@ def updateBook(id):
 
         return jsonify({
             "message": "Book updated successfully",
-            "book": {
-                'id': book.id,
-                'name': book.name,
-                'author': book.author,
-                'year_published': book.year_published,
-                'type': book.type,
-                'is_available': book.is_available
-            }
+            "book": bookToDict(book)
         }), 200
 
     except Exception as e:
@@ -431,11 +2156,11 @@ def updateBook(id):
         }), 500
 
 # Update a customer by ID
-@app.route('/updateCustomer/<int:id>', methods=['PUT'])
+@api.route('/updateCustomer/<int:id>', methods=['PUT'])
 def updateCustomer(id):
     try:
         # Fetch the customer by ID
-        customer = db.session.get(Customer, id)
+        customer = getActive(Customer, id)
         
         if not customer:
             return jsonify({'users': f"customer with id {id} does not exist"}), 404
@@ -454,12 +2179,7 @@ def updateCustomer(id):
         
         return jsonify({
             "message": "Great Success! customer updated",
-            "customer": {
-                'id' : customer.id,
-                'name' : customer.name,
-                'city' : customer.city,
-                'age' : customer.age
-            }
+            "customer": customerToDict(customer)
         }), 200
 
 
@@ -470,7 +2190,7 @@ def updateCustomer(id):
         }), 500  
 
 # Update loan dates by ID
-@app.route('/updateLoan/<int:id>', methods=['PUT'])
+@api.route('/updateLoan/<int:id>', methods=['PUT'])
 def updateLoan(id):
     try:
         # retrieve record
@@ -480,6 +2200,7 @@ def updateLoan(id):
             return jsonify({"message" : f"no such loan with id {id} exist"}), 404
         
         data = request.get_json()
+        before = loanPeriod(loan)
 
          # Update loan_date if provided
         if 'loan_date' in data:
@@ -494,79 +2215,73 @@ def updateLoan(id):
             except ValueError:
                 return jsonify({"error": "Invalid format for return_date. Use ISO format (YYYY-MM-DDTHH:MM:SS)"}), 400
 
+        # a loan ended (or started) by the new dates puts the copy back on the shelf (or takes it)
+        syncLoanClaims([(before, loanPeriod(loan))])
         db.session.commit()
 
         # return 'sss'
         return jsonify({
             "message" : "loan updated successfuly",
-            "loan":{
-                'id':loan.id,
-                'customer_id':loan.customer_id,
-                'book_id':loan.book_id,
-                'loan_date':loan.loan_date,
-                'return_date':loan.return_date
-            }
+            "loan": loanToDict(loan)
         })
     
+    except BookingConflict as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 409
     except Exception as e:
-        pass
+        db.session.rollback()
+        return jsonify({'message': 'error', 'error': str(e)}), 500
 
 #------------------------------------------------
-# Delete Item            I did not initialized isActive field, so choosing to implement deletion fully
+# Delete Item - books & customers are soft deleted (deleted_at), their loan history is kept
 #------------------------------------------------
 
-@app.route('/deleteBook/<int:book_id>', methods=['DELETE'])
+@api.route('/deleteBook/<int:book_id>', methods=['DELETE'])
 def deleteBook(book_id):
     try:
         # Find the book by ID
-        book = Book.query.get(book_id)
+        book = getActive(Book, book_id)
         
         if not book:
             return jsonify({"error": "Book not found."}), 404
         
-        # Delete all loans associated with the book
-        Loan.query.filter_by(book_id=book_id).delete()
-        
-        # Delete the book
-        db.session.delete(book)
+        book.deleted_at = datetime.utcnow()
         db.session.commit()
         
-        return jsonify({"message": f"Book with ID {book_id} and all related loans deleted successfully."}), 200
+        return jsonify({"message": f"Book with ID {book_id} deleted successfully, its loan history is kept."}), 200
     
     except Exception as e:
         db.session.rollback()  # Roll back the transaction if an error occurs
         return jsonify({"error": f"An error occurred while deleting the book: {str(e)}"}), 500
 
-@app.route('/deleteCustomer/<int:customer_id>', methods=['DELETE'])
+@api.route('/deleteCustomer/<int:customer_id>', methods=['DELETE'])
 def deleteCustomer(customer_id):
     try:
         # Find the customer by ID
-        customer = Customer.query.get(customer_id)
+        customer = getActive(Customer, customer_id)
         
         if not customer:
             return jsonify({"error": "Customer not found."}), 404
         
-        # Delete all loans associated with the customer
-        Loan.query.filter_by(customer_id=customer_id).delete()
-        
-        # Delete the customer
-        db.session.delete(customer)
+        customer.deleted_at = datetime.utcnow()
         db.session.commit()
         
-        return jsonify({"message": f"Customer with ID {customer_id} and all related loans deleted successfully."}), 200
+        return jsonify({"message": f"Customer with ID {customer_id} deleted successfully, its loan history is kept."}), 200
     
     except Exception as e:
         db.session.rollback()  # Roll back the transaction if an error occurs
         return jsonify({"error": f"An error occurred while deleting the customer: {str(e)}"}), 500
 
 
-@app.route('/deleteLoan/<int:loan_id>', methods=['DELETE'])
+@api.route('/deleteLoan/<int:loan_id>', methods=['DELETE'])
 def deleteLoan(loan_id):
     try:
         # Find the loan by ID
         loan = Loan.query.get(loan_id)
         
         if loan:
+            # deleting a running loan puts the copy back on the shelf (a reservation holds nothing yet)
+            syncLoanClaims([(loanPeriod(loan), None)])
             db.session.delete(loan)
             db.session.commit()
             return jsonify({"message": f"Loan with ID {loan_id} deleted successfully."}), 200
@@ -577,24 +2292,713 @@ def deleteLoan(loan_id):
         db.session.rollback()  # Roll back the transaction if an error occurs
         return jsonify({"error": f"An error occurred while deleting the loan: {str(e)}"}), 500
 
+#------------------------------------------------
+# Batch Operations
+#------------------------------------------------
+
+# Every batch route takes {"operations": [...]} (or the bare list) where each operation is
+#   {"op": "create", "data": {...}} | {"op": "update", "id": <id>, "data": {...}} | {"op": "delete", "id": <id>}
+# All operations are validated together first - referenced rows are resolved with one query per
+# table - and then applied in a single transaction. If any operation is invalid nothing is applied
+# and the per-item results point at the failing entries.
+
+@api.route('/batchBooks', methods=['POST'])
+def batchBooks():
+    return batchResponse(Book, bookToDict, bookValuesFromData)
+
+@api.route('/batchCustomers', methods=['POST'])
+def batchCustomers():
+    return batchResponse(Customer, customerToDict, customerValuesFromData)
+
+@api.route('/batchLoans', methods=['POST'])
+def batchLoans():
+    return batchResponse(Loan, loanToDict, loanValuesFromData, resolveReferences=resolveLoanReferences,
+                         onDelete=lambda loanIDs: subtractLoansFromSummaries(Loan.id.in_(loanIDs)),
+                         onApplied=syncBatchLoanClaims)
+
+# running loans created / deleted / moved by a batch claim or release their copies like createLoan & deleteLoan
+def syncBatchLoanClaims(applied):
+    periods = lambda values: (values['book_id'], values['loan_date'], values['return_date'])
+    syncLoanClaims([
+        (periods(before) if before else None, None if kind == 'delete' else loanPeriod(row))
+        for kind, before, row in applied
+    ])
+
+# ids in batch operations must be JSON integers (they are looked up in sets)
+def isID(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+# validated column values of a book create (partial=False) or update (partial=True)
+def bookValuesFromData(data, partial, references=None, current=None):
+    values = {}
+    for key in ('name', 'author'):
+        if key in data:
+            if not data[key]:
+                raise ValueError(f"Invalid {key}. Must not be empty.")
+            values[key] = data[key]
+        elif not partial:
+            raise ValueError("Invalid input. Name, author, and valid type (1, 2, or 3) are required.")
+    if 'type' in data or not partial:
+        try:
+            values['type'] = int(data.get('type'))
+        except (TypeError, ValueError):
+            raise ValueError("Invalid type. Must be an integer (1, 2, or 3)")
+        if values['type'] not in [1, 2, 3]:
+            raise ValueError("Invalid type. Must be 1, 2, or 3")
+    if 'year_published' in data:
+        values['year_published'] = data['year_published']
+    if 'is_available' in data:
+        values['is_available'] = bool(data['is_available'])
+    elif not partial:
+        values['is_available'] = True
+    return values
+
+# validated column values of a customer create / update
+def customerValuesFromData(data, partial, references=None, current=None):
+    values = {key: data[key] for key in ('name', 'city', 'age') if key in data}
+    if ('name' in data or not partial) and not data.get('name'):
+        raise ValueError("Invalid input. Name required.")
+    return values
+
+# validated column values of a loan create / update, references holds the existing customer & book ids
+def loanValuesFromData(data, partial, references=None, current=None):
+    values = {}
+    for key in ('customer_id', 'book_id'):
+        if key in data:
+            if not isID(data[key]):
+                raise ValueError(f"Invalid {key}. Must be an integer.")
+            if data[key] not in references[key]:
+                entity = 'Customer' if key == 'customer_id' else 'Book'
+                raise ValueError(f"{entity} with ID {data[key]} does not exist.")
+            values[key] = data[key]
+        elif not partial:
+            raise ValueError("Invalid input. customer_id, book_id and loan_date are required.")
+    for key in ('loan_date', 'return_date'):
+        if data.get(key):
+            try:
+                values[key] = datetime.fromisoformat(data[key])
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid format for {key}. Use ISO format (YYYY-MM-DDTHH:MM:SS)")
+        elif key in data and key == 'return_date':
+            values[key] = None
+        elif key == 'loan_date' and not partial:
+            raise ValueError("Invalid input. customer_id, book_id and loan_date are required.")
+
+    loanDate = values.get('loan_date', current.loan_date if current else None)
+    returnDate = values.get('return_date', current.return_date if current else None)
+    if returnDate and loanDate >= returnDate:
+        raise ValueError("Loan date must be before the return date.")
+    return values
+
+# one query per referenced table instead of a lookup per loan
+def resolveLoanReferences(operations):
+    # malformed data / ids are skipped here, the validation reports them per operation
+    referenced = lambda key: {op['data'][key] for op in operations if isinstance(op.get('data'), dict) and isID(op['data'].get(key))}
+    customerIDs, bookIDs = referenced('customer_id'), referenced('book_id')
+    return {
+        'customer_id': {row.id for row in db.session.query(Customer.id).filter(Customer.id.in_(customerIDs), notDeleted(Customer))} if customerIDs else set(),
+        'book_id': {row.id for row in db.session.query(Book.id).filter(Book.id.in_(bookIDs), notDeleted(Book))} if bookIDs else set(),
+    }
+
+def batchResponse(model, toDict, valuesFromData, resolveReferences=None, onDelete=None, onApplied=None):
+    try:
+        data = request.get_json(silent=True)
+        operations = data.get('operations') if isinstance(data, dict) else data
+        if not isinstance(operations, list) or not operations:
+            return jsonify({"error": "Invalid input. A non empty list of operations is required."}), 400
+        if len(operations) > current_app.config['BATCH_MAX_OPERATIONS']:
+            return jsonify({"error": f"Too many operations. At most {current_app.config['BATCH_MAX_OPERATIONS']} per batch."}), 400
+        if not all(isinstance(op, dict) for op in operations):
+            return jsonify({"error": "Invalid input. Every operation must be an object."}), 400
+
+        # resolve every update/delete target and every reference up front
+        targetIDs = {op.get('id') for op in operations if op.get('op') in ('update', 'delete') and isID(op.get('id'))}
+        targets = {row.id: row for row in model.query.filter(model.id.in_(targetIDs), notDeleted(model))} if targetIDs else {}
+        references = resolveReferences(operations) if resolveReferences else None
+
+        # validate everything before touching the session
+        validated = []
+        results = []
+        deletedIDs = set()
+        for index, op in enumerate(operations):
+            try:
+                kind = op.get('op')
+                if kind not in ('create', 'update', 'delete'):
+                    raise ValueError("Invalid op. Must be create, update or delete.")
+                current = None
+                if kind != 'create':
+                    if not isID(op.get('id')):
+                        raise ValueError("Invalid id. Must be an integer.")
+                    current = targets.get(op.get('id'))
+                    if current is None or op.get('id') in deletedIDs:
+                        raise LookupError(f"{model.__name__} with ID {op.get('id')} not found")
+                    if kind == 'delete':
+                        deletedIDs.add(current.id)
+                values = None
+                if kind != 'delete':
+                    opData = op.get('data')
+                    if not isinstance(opData, dict):
+                        raise ValueError("Invalid input. data must be an object.")
+                    values = valuesFromData(opData, kind == 'update', references, current)
+                validated.append((kind, current, values))
+                results.append({'index': index, 'status': 'ok'})
+            except (ValueError, LookupError) as e:
+                results.append({'index': index, 'status': 'error', 'error': str(e)})
+
+        if any(result['status'] == 'error' for result in results):
+            return jsonify({'message': 'batch rejected, nothing was applied', 'results': results}), 400
+
+        # apply everything in one transaction - the deletes first, so the flush checks (loan overlaps)
+        # already see the rows the batch frees
+        if deletedIDs:
+            if onDelete:
+                onDelete(deletedIDs)
+            deleted = model.query.filter(model.id.in_(deletedIDs))
+            if hasattr(model, 'deleted_at'):
+                deleted.update({model.deleted_at: datetime.utcnow()}, synchronize_session=False)
+            else:
+                deleted.delete(synchronize_session=False)
+                # gone from the table - a row created by the batch may get the same id
+                for objectID in deletedIDs:
+                    db.session.expunge(targets[objectID])
+            logChanges([(model.__table__.name, objectID, 'delete', None) for objectID in sorted(deletedIDs)])
+
+        touched = []
+        applied = []   # (kind, column values before the operation or None, row)
+        for kind, current, values in validated:
+            applied.append((kind, objectToDict(current, model.__table__.columns.keys()) if current is not None else None))
+            if kind == 'create':
+                current = model(**values)
+                db.session.add(current)
+            elif kind == 'update':
+                for key, value in values.items():
+                    setattr(current, key, value)
+            touched.append(current)
+
+        db.session.flush()
+        if onApplied:
+            onApplied([(kind, before, row) for (kind, before), row in zip(applied, touched)])
+
+        # serialize before the commit expires the objects (avoids a reload query per row)
+        for result, (kind, _, _), row in zip(results, validated, touched):
+            result['op'] = kind
+            if kind == 'delete':
+                result['id'] = row.id
+            else:
+                result[model.__name__.lower()] = toDict(row)
+
+        db.session.commit()
+
+        return jsonify({'message': f'successful batch of {len(results)} operations', 'results': results}), 200
+
+    except BookingConflict as e:
+        db.session.rollback()
+        return jsonify({'message': 'batch rejected, nothing was applied', 'error': str(e)}), 409
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'message': 'error',
+            'error': str(e)
+        }), 500
+
+#------------------------------------------------
+# Change feed
+#------------------------------------------------
+
+# changes after a sequence number, oldest first - poll with the returned last_seq
+#   ?since=<seq>  - last sequence number already processed (0 = from the start of the retained log)
+#   ?limit=<n>    - page size (default & cap LIST_MAX_LIMIT)
+#   ?entity=book|customer|loan
+# 410 when `since` predates the retained log (prune-changes): resync from the list endpoints.
+@api.route('/changes', methods=['GET'])
+def listChanges():
+    try:
+        since, entity = changeFeedArgs(request.args)
+        limit = max(1, min(request.args.get('limit', current_app.config['LIST_MAX_LIMIT'], type=int), current_app.config['LIST_MAX_LIMIT']))
+        if changesPruned(since):
+            return jsonify({"error": "since is older than the retained change log, resync from the list endpoints."}), 410
+
+        changes = [changeToDict(row) for row in db.session.execute(changesStatement(since, entity).limit(limit))]
+        return jsonify({
+            'changes': changes,
+            'last_seq': changes[-1]['seq'] if changes else since,
+        }), 200
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({
+            'message': 'error',
+            'error': str(e)
+        }), 500
+
+# the same feed as Server-Sent Events (one "change" event per entry, id = seq). Resumes after
+# ?since or the Last-Event-ID header, polls every CHANGES_POLL_INTERVAL seconds and ends after
+# CHANGES_STREAM_TIMEOUT seconds - EventSource clients reconnect on their own with Last-Event-ID.
+@api.route('/changes/stream', methods=['GET'])
+def streamChanges():
+    try:
+        args = request.args.copy()
+        if request.headers.get('Last-Event-ID'):
+            args['since'] = request.headers['Last-Event-ID']
+        since, entity = changeFeedArgs(args)
+        if changesPruned(since):
+            return jsonify({"error": "since is older than the retained change log, resync from the list endpoints."}), 410
+
+        pollInterval = current_app.config['CHANGES_POLL_INTERVAL']
+        deadline = time.monotonic() + current_app.config['CHANGES_STREAM_TIMEOUT']
+        batchSize = current_app.config['LIST_MAX_LIMIT']
+
+        def generate():
+            lastSeq = since
+            yield 'retry: 1000\n\n'
+            while time.monotonic() < deadline:
+                rows = db.session.execute(changesStatement(lastSeq, entity).limit(batchSize)).all()
+                db.session.rollback()   # don't hold the connection (and a read snapshot) while idle
+                for row in rows:
+                    yield f"id: {row.seq}\nevent: change\ndata: {current_app.json.dumps(changeToDict(row))}\n\n"
+                    lastSeq = row.seq
+                if len(rows) < batchSize:
+                    yield ': keep-alive\n\n'
+                    time.sleep(pollInterval)
+
+        return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({
+            'message': 'error',
+            'error': str(e)
+        }), 500
+
+def changeFeedArgs(args):
+    since = parseIntArg(args, 'since') or 0
+    entity = args.get('entity')
+    if entity is not None and entity not in ('book', 'customer', 'loan'):
+        raise ValueError("Invalid entity. Must be book, customer or loan.")
+    return since, entity
+
+def changesStatement(since, entity=None):
+    statement = db.select(*ChangeLog.__table__.c).where(ChangeLog.seq > since).order_by(ChangeLog.seq)
+    if entity is not None:
+        statement = statement.where(ChangeLog.entity == entity)
+    return statement
+
+# entries between `since` and the oldest retained one were pruned
+def changesPruned(since):
+    oldest = db.session.scalar(db.select(db.func.min(ChangeLog.seq)))
+    return since > 0 and oldest is not None and oldest > since + 1
+
+def changeToDict(row):
+    return {
+        'seq': row.seq,
+        'entity': row.entity,
+        'id': row.entity_id,
+        'op': row.op,
+        'data': current_app.json.loads(row.data) if row.data is not None else None,
+        'at': row.created_at,
+    }
+
 #------------------------------------------------
 # Helpers 
 #------------------------------------------------
 
-# validates existence of customer & book IDs + loanDate>=returnDate
+# ORM object -> dictionary converters (see serializers.py for the schemas)
+def bookToDict(book):
+    return objectToDict(book, BOOK_FIELDS)
+
+def customerToDict(customer):
+    return objectToDict(customer, CUSTOMER_FIELDS)
+
+def loanToDict(loan):
+    return objectToDict(loan, LOAN_FIELDS)
+
+# parses a boolean query parameter ("1"/"true"/"yes" vs "0"/"false"/"no")
+def parseBoolArg(args, key):
+    value = args.get(key)
+    if value is None:
+        return None
+    value = value.lower()
+    if value in ('1', 'true', 'yes'):
+        return True
+    if value in ('0', 'false', 'no'):
+        return False
+    raise ValueError(f"Invalid value for {key}. Use true or false.")
+
+# parses an ISO date(time) query parameter
+def parseDateArg(args, key):
+    value = args.get(key)
+    if value is None:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid format for {key}. Use ISO format (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS)")
+
+# parses an integer query parameter
+def parseIntArg(args, key):
+    value = args.get(key)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"Invalid value for {key}. Must be an integer.")
+
+# /listBooks filters: author, name (prefix), type, is_available, year_from, year_to
+def filterBooks(query, args):
+    if args.get('author'):
+        query = query.filter(Book.author == args['author'])
+    if args.get('name'):
+        # range instead of LIKE so the prefix match can use ix_book_name
+        prefix = args['name']
+        query = query.filter(Book.name >= prefix, Book.name < prefix + '\uffff')
+    bookType = parseIntArg(args, 'type')
+    if bookType is not None:
+        query = query.filter(Book.type == bookType)
+    isAvailable = parseBoolArg(args, 'is_available')
+    if isAvailable is not None:
+        query = query.filter(Book.is_available == isAvailable)
+    yearFrom = parseIntArg(args, 'year_from')
+    if yearFrom is not None:
+        query = query.filter(Book.year_published >= yearFrom)
+    yearTo = parseIntArg(args, 'year_to')
+    if yearTo is not None:
+        query = query.filter(Book.year_published <= yearTo)
+    return query
+
+# /listCustomers filters: city
+def filterCustomers(query, args):
+    if args.get('city'):
+        query = query.filter(Customer.city == args['city'])
+    return query
+
+# /listLoans filters: customer_id, book_id, status (open/returned), from, to (on loan_date)
+def filterLoans(query, args):
+    customerID = parseIntArg(args, 'customer_id')
+    if customerID is not None:
+        query = query.filter(Loan.customer_id == customerID)
+    bookID = parseIntArg(args, 'book_id')
+    if bookID is not None:
+        query = query.filter(Loan.book_id == bookID)
+    status = args.get('status')
+    if status == 'open':
+        query = query.filter(loanIsOpen())
+    elif status == 'returned':
+        query = query.filter(db.not_(loanIsOpen()))
+    elif status is not None:
+        raise ValueError("Invalid status. Must be open or returned.")
+    loanFrom = parseDateArg(args, 'from')
+    if loanFrom is not None:
+        query = query.filter(Loan.loan_date >= loanFrom)
+    loanTo = parseDateArg(args, 'to')
+    if loanTo is not None:
+        query = query.filter(Loan.loan_date <= loanTo)
+    return query
+
+# a loan is open while it has no return date or the return date is still ahead
+def loanIsOpen(now=None):
+    now = now or datetime.utcnow()
+    return db.or_(Loan.return_date.is_(None), Loan.return_date > now)
+
+# Core statements behind the read endpoints, built from the query parameters - shared by the
+# Flask views and the ASGI fast path (asgi.py). They raise ValueError for invalid parameters.
+
+# /listBooks: (statement, model, row -> dictionary)
+def listBooksQuery(args):
+    statement = filterBooks(db.select(*columnsFor(Book, BOOK_FIELDS)).where(notDeleted(Book)), args)
+    return statement, Book, lambda row: rowToDict(row, BOOK_FIELDS)
+
+# /listCustomers: (statement, model, row -> dictionary)
+def listCustomersQuery(args):
+    statement = filterCustomers(db.select(*columnsFor(Customer, CUSTOMER_FIELDS)).where(notDeleted(Customer)), args)
+    return statement, Customer, lambda row: rowToDict(row, CUSTOMER_FIELDS)
+
+# /listLoans: (statement, model, row -> dictionary)
+# ?expand=book,customer - nest the related rows, joined into the same query (no query per loan)
+def listLoansQuery(args):
+    expand = {name for name in args.get('expand', '').split(',') if name}
+    if not expand <= {'book', 'customer'}:
+        raise ValueError("Invalid expand. Use book, customer or both.")
+
+    columns = columnsFor(Loan, LOAN_FIELDS)
+    if 'book' in expand:
+        columns += columnsFor(Book, BOOK_FIELDS, prefix='book_')
+    if 'customer' in expand:
+        columns += columnsFor(Customer, CUSTOMER_FIELDS, prefix='customer_')
+    statement = db.select(*columns)
+    if 'book' in expand:
+        statement = statement.join(Book, Book.id == Loan.book_id)
+    if 'customer' in expand:
+        statement = statement.join(Customer, Customer.id == Loan.customer_id)
+
+    def expandedLoanToDict(row):
+        loanDictionary = rowToDict(row, LOAN_FIELDS)
+        offset = len(LOAN_FIELDS)
+        if 'book' in expand:
+            loanDictionary['book'] = rowToDict(row, BOOK_FIELDS, offset)
+            offset += len(BOOK_FIELDS)
+        if 'customer' in expand:
+            loanDictionary['customer'] = rowToDict(row, CUSTOMER_FIELDS, offset)
+        return loanDictionary
+
+    return filterLoans(statement, args), Loan, expandedLoanToDict
+
+# /archivedLoans: (statement, model, row -> dictionary)
+def archivedLoansQuery(args):
+    statement = db.select(*columnsFor(LoanArchive, ARCHIVED_LOAN_FIELDS))
+    customerID = parseIntArg(args, 'customer_id')
+    if customerID is not None:
+        statement = statement.where(LoanArchive.customer_id == customerID)
+    bookID = parseIntArg(args, 'book_id')
+    if bookID is not None:
+        statement = statement.where(LoanArchive.book_id == bookID)
+    loanFrom = parseDateArg(args, 'from')
+    if loanFrom is not None:
+        statement = statement.where(LoanArchive.loan_date >= loanFrom)
+    loanTo = parseDateArg(args, 'to')
+    if loanTo is not None:
+        statement = statement.where(LoanArchive.loan_date <= loanTo)
+    return statement, LoanArchive, lambda row: rowToDict(row, ARCHIVED_LOAN_FIELDS)
+
+# /searchBooks: ranked statement, limit/offset applied
+def searchBooksQuery(args, dialectName):
+    terms = re.findall(r'\w+', args.get('q', ''))
+    if not terms:
+        raise ValueError("Invalid input. A search query (q) is required.")
+
+    limit, offset = parseIntArg(args, 'limit'), parseIntArg(args, 'offset')
+    limit = max(1, min(20 if limit is None else limit, current_app.config['LIST_MAX_LIMIT']))
+    offset = max(0, offset or 0)
+
+    if dialectName == 'sqlite':
+        # quote every term so user input can't inject FTS operators, prefix match all of them
+        match = ' '.join(f'"{term}"*' for term in terms)
+        # bm25 weights: a hit in the name counts double compared to the author
+        rank = db.func.bm25(db.literal_column('book_fts'), 2.0, 1.0).label('rank')
+        statement = (db.select(*columnsFor(Book, BOOK_FIELDS), rank)
+                     .join(bookFts, bookFts.c.rowid == Book.id)
+                     .where(db.literal_column('book_fts').op('MATCH')(match), notDeleted(Book))
+                     .order_by(rank, Book.id))
+    else:
+        rank = db.literal(0.0).label('rank')
+        statement = db.select(*columnsFor(Book, BOOK_FIELDS), rank).where(notDeleted(Book)).order_by(Book.id)
+        for term in terms:
+            statement = statement.where(db.or_(Book.name.ilike(f'%{term}%'), Book.author.ilike(f'%{term}%')))
+
+    return statement.limit(limit).offset(offset)
+
+def bookSearchResultToDict(row):
+    return dict(rowToDict(row, BOOK_FIELDS), rank=row.rank)
+
+# keyset (id based) pagination + optional NDJSON streaming for the list endpoints
+#   ?after=<id>  - only rows with id greater than the cursor
+#   ?limit=<n>   - page size (capped by LIST_MAX_LIMIT), next cursor returned in the X-Next-After header
+#   ?stream=1    - stream every matching row as NDJSON, fetched in LIST_STREAM_BATCH_SIZE batches
+# without limit/stream the full list is returned, as before.
+# Returns (statement, limit or None, stream) - a page statement fetches limit + 1 rows
+# to know whether another page exists.
+def pagePlan(statement, model, args):
+    after = parseIntArg(args, 'after')
+    limit = parseIntArg(args, 'limit')
+    stream = args.get('stream', '').lower() in ('1', 'true', 'ndjson')
+
+    statement = statement.order_by(model.id)
+    if after is not None:
+        statement = statement.where(model.id > after)
+
+    if stream:
+        return statement.execution_options(yield_per=current_app.config['LIST_STREAM_BATCH_SIZE']), None, True
+    if limit is None:
+        return statement, None, False
+    limit = max(1, min(limit, current_app.config['LIST_MAX_LIMIT']))
+    return statement.limit(limit + 1), limit, False
+
+# X-Next-After cursor of a page fetched with pagePlan (None on the last page)
+def nextCursor(rows, limit):
+    return str(rows[limit - 1].id) if limit is not None and len(rows) > limit else None
+
+# statement is a Core select of row tuples (no ORM hydration), toDict converts one row.
+def listResponse(statement, model, toDict):
+    statement, limit, stream = pagePlan(statement, model, request.args)
+
+    if stream:
+        def generate():
+            for row in db.session.execute(statement):
+                yield current_app.json.dumps(toDict(row)) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    rows = db.session.execute(statement).all()
+    response = jsonify([toDict(row) for row in rows[:limit]])
+    cursor = nextCursor(rows, limit)
+    if cursor:
+        response.headers['X-Next-After'] = cursor
+    return response, 200
+
+# soft deleted books & customers stay in the database for the loan history but are hidden everywhere else
+def notDeleted(model):
+    return model.deleted_at.is_(None) if hasattr(model, 'deleted_at') else db.true()
+
+# the row with this id, None if it doesn't exist or was soft deleted
+def getActive(model, objectID):
+    obj = db.session.get(model, objectID)
+    return obj if obj is not None and getattr(obj, 'deleted_at', None) is None else None
+
+# an export snapshot with the download urls of its files
+def snapshotToDict(snapshot):
+    return {
+        'id': snapshot.id,
+        'kind': snapshot.kind,
+        'format': snapshot.format,
+        'since_seq': snapshot.since_seq,
+        'last_seq': snapshot.last_seq,
+        'created_at': snapshot.created_at,
+        'files': [dict(file, url=url_for('api.exportFile', snapshot_id=snapshot.id, file_name=file['name']))
+                  for file in json.loads(snapshot.files)],
+    }
+
+# ?limit of the recommendation routes
+def recommendationLimit():
+    limit = parseIntArg(request.args, 'limit')
+    return max(1, min(10 if limit is None else limit, current_app.config['LIST_MAX_LIMIT']))
+
+# ?from & ?to of /books/<id>/availability
+def availabilityWindow(args):
+    try:
+        start = datetime.fromisoformat(args['from']) if args.get('from') else datetime.utcnow()
+        end = datetime.fromisoformat(args['to']) if args.get('to') else start + timedelta(days=30)
+    except ValueError:
+        raise ValueError("Invalid format for from / to. Use ISO format (YYYY-MM-DDTHH:MM:SS)")
+    if start >= end:
+        raise ValueError("from must be before to.")
+    return start, end
+
+# validates existence of customer & book IDs (in one query) + loanDate<returnDate
+# returns None when valid, otherwise an (error dictionary, status) tuple
 def loanValidationHelper(customerID, bookID, loanDate, returnDate):
-    customer = db.session.get(Customer, customerID)  # Fetch the customer
-    if not customer:
+    customerExists, bookExists = db.session.query(
+        db.exists().where(Customer.id == customerID, notDeleted(Customer)),
+        db.exists().where(Book.id == bookID, notDeleted(Book))
+    ).one()
+
+    if not customerExists:
         return {"error": f"Customer with ID {customerID} does not exist."}, 400  # Return a 400 Bad Request status
 
-    book = db.session.get(Book, bookID)  # Fetch the customer
-    if not book:
+    if not bookExists:
         return {"error": f"Book with ID {bookID} does not exist."}, 400  # Return a 400 Bad Request status
 
     if returnDate and loanDate >= returnDate:
-            return {"error": "Loan date must be before the return date."}, 400
+        return {"error": "Loan date must be before the return date."}, 400
+
+# marks the book as lent if (and only if) it is currently available - and, when given, the customer exists.
+# A single conditional UPDATE, so two concurrent checkouts can never both get the copy. A copy still
+# flagged as lent by a loan that has ended since (return date passed) counts as available.
+# Returns whether the book was claimed; runs inside the caller's transaction.
+def claimBook(bookID, customerID=None):
+    conditions = [Book.id == bookID, db.or_(Book.is_available == True, ~runningLoanOf(bookID)), notDeleted(Book)]
+    if customerID is not None:
+        conditions.append(db.exists().where(Customer.id == customerID, notDeleted(Customer)))
+    claimed = db.session.execute(
+        db.update(Book).where(*conditions).values(is_available=False)
+        .returning(*columnsFor(Book, BOOK_FIELDS))
+        .execution_options(synchronize_session=False)
+    ).all()
+    logReturnedRows(Book, claimed)
+    return len(claimed) == 1
+
+# puts the book back on the shelf, inside the caller's transaction
+def releaseBook(bookID):
+    released = db.session.execute(
+        db.update(Book).where(Book.id == bookID).values(is_available=True)
+        .returning(*columnsFor(Book, BOOK_FIELDS))
+        .execution_options(synchronize_session=False)
+    ).all()
+    logReturnedRows(Book, released)
+
+# a loan of the book holds the copy right now
+def runningLoanOf(bookID, now=None):
+    now = now or datetime.utcnow()
+    return db.exists().where(Loan.book_id == bookID, Loan.loan_date <= now, loanIsOpen(now))
+
+# puts back on the shelf a copy still flagged as lent although none of its loans runs anymore
+# (a loan whose return date simply passed). Returns whether it was released.
+def releaseEndedClaim(bookID):
+    released = db.session.execute(
+        db.update(Book).where(Book.id == bookID, Book.is_available == False, ~runningLoanOf(bookID))
+        .values(is_available=True)
+        .returning(*columnsFor(Book, BOOK_FIELDS))
+        .execution_options(synchronize_session=False)
+    ).all()
+    logReturnedRows(Book, released)
+    return len(released) == 1
+
+# whether a loan over [loanDate, returnDate) holds the copy right now
+def loanIsRunning(loanDate, returnDate, now=None):
+    now = now or datetime.utcnow()
+    return loanDate <= now and (returnDate is None or returnDate > now)
+
+# Claims / releases the copies of loans that started or stopped running, inside the caller's
+# transaction. changes: [(before, after)] with (book_id, loan_date, return_date) tuples, None for a
+# created (before) or deleted (after) loan. Raises BookingConflict when a copy can't be claimed.
+def syncLoanClaims(changes):
+    now = datetime.utcnow()
+    claims, releases = [], []
+    for before, after in changes:
+        wasRunning = before is not None and loanIsRunning(before[1], before[2], now)
+        isRunning = after is not None and loanIsRunning(after[1], after[2], now)
+        if wasRunning and isRunning and before[0] == after[0]:
+            continue
+        if wasRunning:
+            releases.append(before[0])
+        if isRunning:
+            claims.append(after[0])
+    for bookID in releases:
+        releaseBook(bookID)
+    for bookID in claims:
+        if not claimBook(bookID):
+            raise BookingConflict(f"Book with ID {bookID} is not available.")
+
+def loanPeriod(loan):
+    return loan.book_id, loan.loan_date, loan.return_date
+
 #------------------------------------------------
-# Rest Api
+# App factory
 #------------------------------------------------
+
+# builds the app for a configuration object of config.py (LIBRARY_ENV by default), keyword
+# arguments override single settings. Nothing connects to the database here - the pool opens
+# its connections on first use, so a preloaded gunicorn master forks without open sockets.
+#   flask --app app ...           (the flask CLI finds create_app on its own)
+#   gunicorn -c gunicorn.conf.py  (production, see gunicorn.conf.py)
+def create_app(config=None, **overrides):
+    app = Flask(__name__)
+    app.config.from_object(config or config_from_env())
+    app.config.update(overrides)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+
+    # orjson backed JSON provider (stdlib fallback) - uniform ISO 8601 dates
+    app.json_provider_class = FastJSONProvider
+    app.json = FastJSONProvider(app)
+
+    if app.config['CORS_ORIGINS']:
+        CORS(app, origins=app.config['CORS_ORIGINS'], expose_headers=['X-Next-After', 'ETag'])
+
+    db.init_app(app)
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect', sqlitePragmasListener(app.config['SQLITE_PRAGMAS']))
+
+    app.extensions['response_cache'] = create_cache(app.config)
+    app.register_blueprint(api)
+    init_instrumentation(app)
+    init_throttling(app)
+    return app
+
+# development server only (LIBRARY_ENV=development for the debugger & reloader)
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    app = create_app()
+    app.run(debug=app.config['DEBUG'])
\ No newline at end of file
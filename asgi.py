@@ -0,0 +1,211 @@
+#------------------------------------------------
+# imports
+#------------------------------------------------
+import hashlib
+import math
+import os
+from urllib.parse import parse_qsl
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_etags
+from app import (create_app, db, bookSearchResultToDict, generationsInDatabase, generationsKey, listBooksQuery,
+                 listCustomersQuery, listLoansQuery, nextCursor, pagePlan, responseCache, responseCacheKey,
+                 searchBooksQuery, storedGenerationsStatement, tableGenerations)
+from throttle import rateLimitedRequests
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+    from sqlalchemy.ext.asyncio import create_async_engine
+except ImportError:  # optional - pip install -r requirements-asgi.txt
+    WsgiToAsgi = None
+
+#------------------------------------------------
+# ASGI mode
+#
+# uvicorn asgi:application
+#
+# The read heavy routes (/listBooks, /listCustomers, /listLoans, /searchBooks) are served
+# here with an async engine, so a slow query or a long NDJSON stream doesn't hold a worker
+# thread. They build the same statements as the Flask views and share the response cache.
+# Every other request goes to the Flask app through the WSGI adapter.
+#------------------------------------------------
+
+app = create_app()
+
+# async driver of the configured database (LIBRARY_ASYNC_DATABASE_URL to override)
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+
+def async_database_url():
+    if os.environ.get('LIBRARY_ASYNC_DATABASE_URL'):
+        return os.environ['LIBRARY_ASYNC_DATABASE_URL']
+    with app.app_context():
+        url = db.engine.url   # relative sqlite paths resolved by Flask-SQLAlchemy
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+# route -> (statement builder, tables of the cache key)
+# a builder returns (statement, model for pagination or None, row -> dictionary)
+def searchRoute(args):
+    return searchBooksQuery(args, asyncEngine.dialect.name), None, bookSearchResultToDict
+
+ASYNC_ROUTES = {
+    '/listBooks': (listBooksQuery, ('book',)),
+    '/listCustomers': (listCustomersQuery, ('customer',)),
+    '/listLoans': (listLoansQuery, ('loan', 'book', 'customer')),
+    '/searchBooks': (searchRoute, ('book',)),
+}
+
+#------------------------------------------------
+# Async engine
+#------------------------------------------------
+
+asyncEngine = None
+
+# same pool settings as the sync engine (SQLALCHEMY_ENGINE_OPTIONS, config.engine_options by default)
+def create_async_db_engine():
+    url = make_url(async_database_url())
+    engine = create_async_engine(url, **app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+
+    # same pragmas as the sync pool (the aiosqlite connection isn't a sqlite3.Connection)
+    if url.get_backend_name() == 'sqlite':
+        @event.listens_for(engine.sync_engine, 'connect')
+        def setAsyncSqlitePragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma, value in app.config['SQLITE_PRAGMAS'].items():
+                cursor.execute(f"PRAGMA {pragma}={value}")
+            cursor.close()
+
+    return engine
+
+#------------------------------------------------
+# Responses
+#------------------------------------------------
+
+async def sendResponse(send, status, body=b'', headers=(), mimetype='application/json'):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', mimetype.encode())] + [(name.encode(), value.encode()) for name, value in headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def sendJson(send, status, obj):
+    await sendResponse(send, status, app.json.dumps(obj).encode())
+
+# list & search responses, same format as the Flask views (listResponse / searchBooks)
+async def renderRoute(path, args):
+    builder, _ = ASYNC_ROUTES[path]
+    statement, model, toDict = builder(args)
+    limit = None
+    if model is not None:
+        statement, limit, _ = pagePlan(statement, model, args)
+
+    async with asyncEngine.connect() as conn:
+        rows = (await conn.execute(statement)).all()
+
+    headers = {}
+    cursor = nextCursor(rows, limit)
+    if cursor:
+        headers['X-Next-After'] = cursor
+    return app.json.dumps([toDict(row) for row in rows[:limit]]).encode(), headers
+
+# generations of the cache key - read with the async engine when they are kept in the database
+async def cacheGenerations(cache, tables):
+    if not generationsInDatabase(cache):
+        return tableGenerations(tables)
+    async with asyncEngine.connect() as conn:
+        return generationsKey(tables, dict((await conn.execute(storedGenerationsStatement(tables))).all()))
+
+# ?stream=1 - NDJSON, fetched in LIST_STREAM_BATCH_SIZE batches
+async def streamRoute(send, path, args):
+    builder, _ = ASYNC_ROUTES[path]
+    statement, model, toDict = builder(args)
+    statement, _, _ = pagePlan(statement, model, args)
+
+    async with asyncEngine.connect() as conn:
+        result = await conn.stream(statement)
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'application/x-ndjson')]})
+        async for rows in result.partitions(app.config['LIST_STREAM_BATCH_SIZE']):
+            body = ''.join(app.json.dumps(toDict(row)) + '\n' for row in rows)
+            await send({'type': 'http.response.body', 'body': body.encode(), 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+async def handleRoute(scope, send):
+    path = scope['path']
+    args = MultiDict(parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True))
+    requestHeaders = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+
+    # same per client buckets as the rateLimited('list') Flask views
+    limiter = app.extensions.get('rate_limiters', {}).get('list')
+    if limiter is not None:
+        header = (app.config.get('RATE_LIMIT_CLIENT_HEADER') or '').lower()
+        client = requestHeaders.get(header) or (scope.get('client') or ('unknown',))[0]
+        retryAfter = limiter.acquire(client)
+        if retryAfter:
+            rateLimitedRequests.inc(path, 'list')
+            return await sendResponse(send, 429, app.json.dumps({'error': 'Too many requests. Retry later.'}).encode(),
+                                      [('Retry-After', str(math.ceil(retryAfter)))])
+
+    if args.get('stream') and path != '/searchBooks':
+        return await streamRoute(send, path, args)
+
+    cache = responseCache()
+    if cache is None:
+        body, headers = await renderRoute(path, args)
+        return await sendResponse(send, 200, body, headers.items())
+
+    # same key & entry format as cachedResponse, so both modes share the cached responses
+    tables = ASYNC_ROUTES[path][1]
+    key = responseCacheKey(path, args, tables, await cacheGenerations(cache, tables))
+    cached = cache.get(key)
+    if cached is None:
+        body, headers = await renderRoute(path, args)
+        cached = {'status': 200, 'body': body, 'mimetype': 'application/json', 'headers': headers,
+                  'etag': hashlib.sha1(body).hexdigest()}
+        cache.set(key, cached)
+
+    etagHeader = [('ETag', f'"{cached["etag"]}"')]
+    if parse_etags(requestHeaders.get('if-none-match')).contains(cached['etag']):
+        return await sendResponse(send, 304, headers=etagHeader)
+    await sendResponse(send, 200, cached['body'], list(cached['headers'].items()) + etagHeader, cached['mimetype'])
+
+#------------------------------------------------
+# Application
+#------------------------------------------------
+
+async def lifespan(receive, send):
+    global asyncEngine
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            asyncEngine = asyncEngine or create_async_db_engine()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if asyncEngine is not None:
+                await asyncEngine.dispose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+def create_asgi_app():
+    if WsgiToAsgi is None:
+        raise RuntimeError("ASGI mode needs the packages of requirements-asgi.txt (asgiref, aiosqlite, uvicorn).")
+    flaskApp = WsgiToAsgi(app)
+
+    async def application(scope, receive, send):
+        global asyncEngine
+        if scope['type'] == 'lifespan':
+            return await lifespan(receive, send)
+        if scope['type'] != 'http' or scope['method'] != 'GET' or scope['path'] not in ASYNC_ROUTES:
+            return await flaskApp(scope, receive, send)
+
+        # servers without lifespan support
+        asyncEngine = asyncEngine or create_async_db_engine()
+        try:
+            with app.app_context():   # the shared helpers read the config & cache of the current app
+                await handleRoute(scope, send)
+        except ValueError as e:
+            await sendJson(send, 400, {'error': str(e)})
+        except Exception as e:
+            await sendJson(send, 500, {'message': 'error', 'error': str(e)})
+
+    return application
+
+application = create_asgi_app()
@@ -0,0 +1,351 @@
+#------------------------------------------------
+# Latency / throughput benchmark of every REST route
+#
+#   python benchmarks/run.py --loans 100000                      # Flask test client, in process
+#   python benchmarks/run.py --loans 100000 --gunicorn --workers 4 --concurrency 16
+#   python benchmarks/run.py --loans 100000 --compare benchmarks/results/<previous>.json
+#
+# Seeds a fresh SQLite database from the synthetic dataset of seed.py, runs every
+# scenario and writes throughput and p50/p99 latencies to benchmarks/results/*.json.
+#------------------------------------------------
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import seed
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, 'results')
+DATA_DIR = os.path.join(BENCHMARKS_DIR, '.data')
+
+#------------------------------------------------
+# Scenarios
+#------------------------------------------------
+
+# ids created while the benchmark runs, reused by the scenarios depending on them
+class State:
+    def __init__(self, sizes, rng):
+        self.sizes = sizes
+        self.rng = rng
+        self.created_books = []
+        self.created_customers = []
+        self.created_loans = []
+        self.loan_dates = {}   # created loan id -> loan_date
+        self.checkout_loans = []
+
+    def book(self):
+        return self.rng.randint(1, self.sizes['books'])
+
+    def customer(self):
+        return self.rng.randint(1, self.sizes['customers'])
+
+    def loan(self):
+        return self.rng.randint(1, self.sizes['loans'])
+
+# a route exercised by the benchmark:
+#   build(state, i) -> (method, path, json body or None)
+#   collect(state, i, response json) - optional, records created ids
+class Scenario:
+    def __init__(self, name, build, collect=None):
+        self.name = name
+        self.build = build
+        self.collect = collect
+
+def get(path):
+    return lambda state, i: ('GET', path(state, i) if callable(path) else path, None)
+
+def created(pool, key):
+    return lambda state, i, body: getattr(state, pool).append(body[key]['id'])
+
+def createdLoan(state, i, body):
+    state.created_loans.append(body['Loan']['id'])
+    state.loan_dates[body['Loan']['id']] = datetime.fromisoformat(body['Loan']['loan_date'])
+
+# loans of a book can't overlap: every created loan gets its own 2 hour window, 3 hours apart and
+# after the seeded loans, so the write scenarios measure successful bookings and not the 409 path
+def loanWindow(base, n):
+    start = base + timedelta(hours=3 * n)
+    return start, start + timedelta(hours=2)
+
+CREATE_LOAN_BASE = datetime(2100, 1, 1)
+BATCH_LOAN_BASE = datetime(2110, 1, 1)
+
+SCENARIOS = [
+    Scenario('listBooks page', get(lambda s, i: f"/listBooks?limit=100&after={s.book()}")),
+    Scenario('listBooks filtered', get(lambda s, i: f"/listBooks?author=Author%20{s.rng.randint(1, max(1, s.sizes['books'] // 20))}&limit=100")),
+    Scenario('listCustomers page', get(lambda s, i: f"/listCustomers?limit=100&after={s.customer()}")),
+    Scenario('listLoans page', get(lambda s, i: f"/listLoans?limit=100&after={s.loan()}")),
+    Scenario('listLoans expanded', get(lambda s, i: f"/listLoans?limit=100&after={s.loan()}&expand=book,customer")),
+    Scenario('listLoans customer', get(lambda s, i: f"/listLoans?customer_id={s.customer()}")),
+    Scenario('listLoans stream 1k', get(lambda s, i: f"/listLoans?stream=1&after={max(0, s.sizes['loans'] - 1000)}")),
+    Scenario('searchBooks', get(lambda s, i: f"/searchBooks?q={s.rng.choice(seed.WORDS)}%20{s.rng.choice(seed.WORDS)[:3]}")),
+    Scenario('book details', get(lambda s, i: f"/books/{s.book()}")),
+    Scenario('customer details', get(lambda s, i: f"/customers/{s.customer()}")),
+    Scenario('overdueLoans', get('/overdueLoans?limit=100')),
+    Scenario('overdueSummary', get('/overdueSummary')),
+    Scenario('report loansPerBook', get('/reports/loansPerBook')),
+    Scenario('report loansPerCustomer', get('/reports/loansPerCustomer')),
+    Scenario('report loansPerCity', get('/reports/loansPerCity')),
+    Scenario('report loansPerMonth', get('/reports/loansPerMonth')),
+    Scenario('report topAuthors', get('/reports/topAuthors')),
+    Scenario('report utilizationByType', get('/reports/utilizationByType')),
+    Scenario('createBook', lambda s, i: ('POST', '/createBook', {'name': f"Bench Book {i}", 'author': 'Bench Author', 'type': 1 + i % 3, 'year_published': 2024}),
+             created('created_books', 'book')),
+    Scenario('createCustomer', lambda s, i: ('POST', '/createCustomer', {'name': f"Bench Customer {i}", 'city': 'Bench City', 'age': 30}),
+             created('created_customers', 'customer')),
+    Scenario('createLoan', lambda s, i: ('POST', '/createLoan', {'customer_id': s.customer(), 'book_id': s.book(),
+                                                                   **dict(zip(('loan_date', 'return_date'), (d.strftime('%Y-%m-%d %H:%M') for d in loanWindow(CREATE_LOAN_BASE, i))))}),
+             createdLoan),
+    Scenario('checkoutBook', lambda s, i: ('POST', '/checkoutBook', {'customer_id': s.customer(), 'book_id': s.created_books[i % len(s.created_books)]}),
+             created('checkout_loans', 'loan')),
+    Scenario('returnBook', lambda s, i: ('POST', f"/returnBook/{s.checkout_loans[i % len(s.checkout_loans)]}", {})),
+    Scenario('updateBook', lambda s, i: ('PUT', f"/updateBook/{s.book()}", {'year_published': 1900 + i % 100})),
+    Scenario('updateCustomer', lambda s, i: ('PUT', f"/updateCustomer/{s.customer()}", {'city': f"City {i % 200}"})),
+    Scenario('updateLoan', lambda s, i: ('PUT', f"/updateLoan/{s.created_loans[i % len(s.created_loans)]}", {'return_date': (s.loan_dates[s.created_loans[i % len(s.created_loans)]] + timedelta(minutes=150)).isoformat()})),
+    Scenario('batchBooks 100', lambda s, i: ('POST', '/batchBooks', {'operations': [
+        {'op': 'create', 'data': {'name': f"Batch Book {i}-{n}", 'author': 'Bench Author', 'type': 1}} for n in range(100)]})),
+    Scenario('batchLoans 100', lambda s, i: ('POST', '/batchLoans', {'operations': [
+        {'op': 'create', 'data': {'customer_id': s.customer(), 'book_id': s.book(),
+                                  **dict(zip(('loan_date', 'return_date'), (d.isoformat() for d in loanWindow(BATCH_LOAN_BASE, i * 100 + n))))}} for n in range(100)]})),
+    Scenario('deleteLoan', lambda s, i: ('DELETE', f"/deleteLoan/{s.created_loans.pop()}", None)),
+    Scenario('deleteCustomer', lambda s, i: ('DELETE', f"/deleteCustomer/{s.created_customers.pop()}", None)),
+    Scenario('deleteBook', lambda s, i: ('DELETE', f"/deleteBook/{s.created_books.pop()}", None)),
+]
+
+#------------------------------------------------
+# Clients
+#------------------------------------------------
+
+# in process, through the Flask test client
+class TestClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body):
+        response = self.client.open(path, method=method, json=body)
+        data = response.get_data()
+        return response.status_code, data
+
+# over HTTP, against a running server (gunicorn)
+class HttpClient:
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def request(self, method, path, body):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, method=method,
+                                         headers={'Content-Type': 'application/json'} if data else {})
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+#------------------------------------------------
+# Measurements
+#------------------------------------------------
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def run_scenario(client, scenario, state, requests, concurrency):
+    # paths & bodies are built up front so the timing only covers the requests
+    calls = [scenario.build(state, i) for i in range(requests)]
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def call(i):
+        nonlocal errors
+        method, path, body = calls[i]
+        started = time.perf_counter()
+        status, data = client.request(method, path, body)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if status >= 400:
+                errors += 1
+        if scenario.collect and status < 400:
+            scenario.collect(state, i, json.loads(data))
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(call, range(requests)))
+    else:
+        for i in range(requests):
+            call(i)
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': errors,
+        'throughput_rps': round(requests / wall, 1) if wall else None,
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3),
+    }
+
+# regressions of p50/p99 beyond threshold (fraction) compared to a previous results file
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = []
+    print(f"\n{'route':28} {'p50 ms':>18} {'p99 ms':>18}")
+    for name, current in results['routes'].items():
+        previous = baseline['routes'].get(name)
+        if not previous:
+            continue
+        cells = []
+        for metric in ('p50_ms', 'p99_ms'):
+            change = (current[metric] - previous[metric]) / previous[metric] if previous[metric] else 0.0
+            cells.append(f"{previous[metric]:>7.2f} -> {current[metric]:>7.2f}")
+            if change > threshold:
+                regressions.append((name, metric, change))
+        print(f"{name:28} {cells[0]:>18} {cells[1]:>18}")
+    for name, metric, change in regressions:
+        print(f"REGRESSION {name} {metric} +{change:.0%}")
+    return regressions
+
+#------------------------------------------------
+# Setup
+#------------------------------------------------
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_gunicorn(workers, env):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py', '--workers', str(workers), '--bind', f"127.0.0.1:{port}"],
+        cwd=REPO_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(base_url + '/listBooks?limit=1', timeout=1)
+            return process, base_url
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("gunicorn did not start")
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark every REST route of the library backend.')
+    parser.add_argument('--loans', type=int, default=10000, help='dataset size in loans (10k - 5M), see seed.py')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--routes', help='comma separated scenario names to run (default all)')
+    parser.add_argument('--cache', action='store_true', help='keep the response cache on (off by default to measure the database path)')
+    parser.add_argument('--gunicorn', action='store_true', help='benchmark a local gunicorn instead of the test client')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--concurrency', type=int, default=1, help='concurrent clients')
+    parser.add_argument('--output', help='results file (default benchmarks/results/<timestamp>.json)')
+    parser.add_argument('--compare', help='previous results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='regression threshold for --compare (0.2 = +20%%)')
+    args = parser.parse_args()
+
+    paths = seed.generate(args.loans)
+    sizes = seed.sizes_for(args.loans)
+
+    # a fresh database per run so every run starts from the same state
+    os.makedirs(DATA_DIR, exist_ok=True)
+    database = os.path.join(DATA_DIR, f"bench-{args.loans}.db")
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(database + suffix):
+            os.remove(database + suffix)
+    env = dict(os.environ, LIBRARY_DATABASE_URL=f"sqlite:///{database}")
+    if not args.cache:
+        env['LIBRARY_CACHE_BACKEND'] = 'none'
+    os.environ.update(env)
+
+    sys.path.insert(0, REPO_DIR)
+    from app import create_app, db, import_json_file
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        for source in ('books', 'customers', 'loans'):
+            stats = import_json_file(source, paths[source], chunk_size=20000)
+            print(f"seeded {source}: {stats['rows']} rows ({stats['rows_per_second']} rows/s)")
+
+    process = None
+    if args.gunicorn:
+        process, base_url = start_gunicorn(args.workers, env)
+        client = HttpClient(base_url)
+    else:
+        client = TestClient(app)
+
+    selected = set(args.routes.split(',')) if args.routes else None
+    state = State(sizes, random.Random(7))
+    results = {
+        'meta': {
+            'timestamp': datetime.utcnow().isoformat(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'mode': 'gunicorn' if args.gunicorn else 'test_client',
+            'workers': args.workers if args.gunicorn else None,
+            'concurrency': args.concurrency,
+            'cache': args.cache,
+            'sizes': sizes,
+        },
+        'routes': {},
+    }
+
+    try:
+        for scenario in SCENARIOS:
+            if selected and scenario.name not in selected:
+                continue
+            # the pools of created ids limit the delete scenarios
+            requests = args.requests
+            if scenario.name.startswith('delete'):
+                pool = {'deleteLoan': state.created_loans, 'deleteCustomer': state.created_customers,
+                        'deleteBook': state.created_books}[scenario.name]
+                requests = min(requests, len(pool))
+            if not requests:
+                continue
+            # concurrent deletes would pop ids from shared pools, keep mutating scenarios predictable
+            concurrency = 1 if scenario.name.startswith(('delete', 'checkout', 'return')) else args.concurrency
+            measured = run_scenario(client, scenario, state, requests, concurrency)
+            results['routes'][scenario.name] = measured
+            print(f"{scenario.name:28} {measured['throughput_rps']:>9} req/s  p50 {measured['p50_ms']:>8} ms  "
+                  f"p99 {measured['p99_ms']:>8} ms  errors {measured['errors']}")
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.utcnow():%Y%m%dT%H%M%S}-{args.loans}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    print(f"results written to {output}")
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
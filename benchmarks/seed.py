@@ -0,0 +1,95 @@
+#------------------------------------------------
+# Synthetic dataset generator for the benchmarks
+#
+# Writes books / customers / loans as NDJSON, in the same record format as
+# the mockup/*.json files, so they can be loaded with the bulk import:
+#   python benchmarks/seed.py --loans 1000000
+#   flask --app app import-data loans mockup/generated/loans-1000000/loans.ndjson
+#------------------------------------------------
+from datetime import datetime, timedelta
+import argparse
+import json
+import os
+import random
+
+GENERATED_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'mockup', 'generated')
+
+# default table sizes for a given number of loans
+def sizes_for(loans):
+    return {
+        'books': max(100, loans // 10),
+        'customers': max(100, loans // 20),
+        'loans': loans,
+    }
+
+def book_records(count, rng):
+    for book_id in range(1, count + 1):
+        yield {
+            'ID': book_id,
+            'name': f"Book Title {book_id} {rng.choice(WORDS)} {rng.choice(WORDS)}",
+            'author': f"Author {rng.randint(1, max(1, count // 20))}",
+            'year_published': rng.randint(1900, 2024),
+            'type': rng.randint(1, 3),
+            'is_available': True,
+        }
+
+def customer_records(count, rng):
+    for customer_id in range(1, count + 1):
+        yield {
+            'id': customer_id,
+            'name': f"Customer {customer_id}",
+            'city': f"City {rng.randint(1, 200)}",
+            'age': rng.randint(16, 90),
+        }
+
+# loans spread over the last three years, all of them returned (so checkouts in the benchmark succeed)
+def loan_records(count, books, customers, rng):
+    start = datetime(2022, 1, 1)
+    for loan_id in range(1, count + 1):
+        loan_date = start + timedelta(minutes=rng.randint(0, 3 * 365 * 24 * 60))
+        yield {
+            'id': loan_id,
+            'customer_id': rng.randint(1, customers),
+            'book_id': rng.randint(1, books),
+            'loan_date': loan_date.isoformat(),
+            'return_date': (loan_date + timedelta(days=rng.randint(1, 14))).isoformat(),
+        }
+
+WORDS = ['Shadow', 'River', 'Garden', 'Winter', 'Empire', 'Secret', 'Silver', 'Night', 'Ocean', 'Fire',
+         'Memory', 'Stone', 'Glass', 'Journey', 'Storm', 'Light', 'Forest', 'Crown', 'Dream', 'Echo']
+
+def write_ndjson(path, records):
+    with open(path, 'w') as ndjson_file:
+        for record in records:
+            ndjson_file.write(json.dumps(record) + '\n')
+
+# generates (or reuses) the dataset and returns {source: file path}
+def generate(loans, books=None, customers=None, seed=42, output_dir=None, force=False):
+    sizes = sizes_for(loans)
+    sizes['books'] = books or sizes['books']
+    sizes['customers'] = customers or sizes['customers']
+    output_dir = output_dir or os.path.join(GENERATED_DIR, f"loans-{loans}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    paths = {source: os.path.join(output_dir, f"{source}.ndjson") for source in sizes}
+    if not force and all(os.path.exists(path) for path in paths.values()):
+        return paths
+
+    rng = random.Random(seed)
+    write_ndjson(paths['books'], book_records(sizes['books'], rng))
+    write_ndjson(paths['customers'], customer_records(sizes['customers'], rng))
+    write_ndjson(paths['loans'], loan_records(loans, sizes['books'], sizes['customers'], rng))
+    return paths
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic library dataset (NDJSON).')
+    parser.add_argument('--loans', type=int, default=10000, help='number of loans (10k - 5M)')
+    parser.add_argument('--books', type=int, help='number of books (default loans / 10)')
+    parser.add_argument('--customers', type=int, help='number of customers (default loans / 20)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output-dir', help=f'default {GENERATED_DIR}/loans-<n>')
+    parser.add_argument('--force', action='store_true', help='regenerate existing files')
+    args = parser.parse_args()
+
+    for source, path in generate(args.loans, args.books, args.customers, args.seed, args.output_dir, args.force).items():
+        print(f"{source}: {path}")
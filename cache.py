@@ -0,0 +1,109 @@
+#------------------------------------------------
+# imports
+#------------------------------------------------
+from collections import OrderedDict
+import pickle
+import threading
+import time
+
+try:
+    import redis
+except ImportError:  # optional - only needed for CACHE_BACKEND = 'redis'
+    redis = None
+
+#------------------------------------------------
+# Cache backends
+#
+# Both backends store arbitrary picklable values with a TTL and keep
+# integer counters (used as per-table generations for invalidation).
+#------------------------------------------------
+
+# in-process LRU cache with a per entry TTL
+class LRUCache:
+    shared = False   # each worker has its own - its counters can't tell the workers about writes
+
+    def __init__(self, max_entries=1024, default_ttl=60):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()   # key -> (expires_at, value)
+        self._counters = {}             # never evicted, generations must not go back
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (ttl or self.default_ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_counter(self, key):
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+# cache shared by every worker through a Redis compatible client
+# (anything with get/set(ex=)/incr - redis.Redis, fakeredis, a local stand-in...)
+class RedisCache:
+    shared = True
+
+    def __init__(self, client, default_ttl=60, prefix='library:'):
+        self.client = client
+        self.default_ttl = default_ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl or self.default_ttl)
+
+    def get_counter(self, key):
+        value = self.client.get(self.prefix + 'counter:' + key)
+        return int(value) if value is not None else 0
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + 'counter:' + key)
+
+    def clear(self):
+        # entries expire on their own, bumping the generations is what invalidates them
+        pass
+
+# builds the backend selected by CACHE_BACKEND ('memory', 'redis' or 'none' -> None)
+def create_cache(config):
+    backend = config.get('CACHE_BACKEND', 'memory')
+    ttl = config.get('CACHE_TTL', 60)
+
+    if backend == 'none':
+        return None
+    if backend == 'memory':
+        return LRUCache(max_entries=config.get('CACHE_MAX_ENTRIES', 1024), default_ttl=ttl)
+    if backend == 'redis':
+        if redis is None:
+            raise RuntimeError("CACHE_BACKEND is 'redis' but the redis package is not installed.")
+        return RedisCache(redis.Redis.from_url(config['CACHE_REDIS_URL']), default_ttl=ttl)
+    raise ValueError(f"Unknown CACHE_BACKEND {backend}. Use memory, redis or none.")
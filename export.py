@@ -0,0 +1,113 @@
+#------------------------------------------------
+# imports
+#------------------------------------------------
+import csv
+import gzip
+import os
+from datetime import date, datetime
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional - pip install -r requirements-export.txt, gzip CSV only otherwise
+    pa = None
+
+#------------------------------------------------
+# Snapshot file writers
+#
+# A table is written batch by batch (one Parquet row group / Arrow record batch / run of CSV lines
+# per batch), so an export never holds more than one batch in memory. Files are written under a
+# temporary name and renamed once complete - a file that exists is always whole.
+#------------------------------------------------
+
+# format -> file extension
+FORMATS = {
+    'parquet': '.parquet',      # columnar, zstd compressed (pyarrow)
+    'arrow': '.arrow',          # Arrow IPC file, zstd compressed (pyarrow)
+    'csv': '.csv.gz',           # gzip compressed CSV with a header line (standard library)
+}
+
+def default_format():
+    return 'parquet' if pa is not None else 'csv'
+
+def check_format(format):
+    if format not in FORMATS:
+        raise ValueError(f"Unknown export format {format}. Use {', '.join(FORMATS)}.")
+    if format != 'csv' and pa is None:
+        raise ValueError(f"The {format} export format needs pyarrow (pip install -r requirements-export.txt), use csv.")
+
+# python type of a column -> arrow type
+def arrowType(pythonType):
+    if pa is None:
+        return None
+    return {
+        bool: pa.bool_(),
+        int: pa.int64(),
+        float: pa.float64(),
+        str: pa.string(),
+        datetime: pa.timestamp('us'),
+        date: pa.date32(),
+    }.get(pythonType, pa.string())
+
+# Writes batches of row tuples to <path><extension>. columns: [(name, python type)] in the order of
+# the row tuples. Returns (file name, number of rows).
+def write_table(path, columns, batches, format):
+    check_format(format)
+    fileName = path + FORMATS[format]
+    temporary = fileName + '.tmp'
+    writer = {'parquet': writeParquet, 'arrow': writeArrow, 'csv': writeCsv}[format]
+    try:
+        rows = writer(temporary, columns, batches)
+        os.replace(temporary, fileName)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return os.path.basename(fileName), rows
+
+def arrowSchema(columns):
+    return pa.schema([(name, arrowType(pythonType)) for name, pythonType in columns])
+
+def recordBatch(schema, batch):
+    values = list(zip(*batch))
+    return pa.RecordBatch.from_arrays([pa.array(column, type=field.type) for column, field in zip(values, schema)], schema=schema)
+
+def writeParquet(path, columns, batches):
+    schema = arrowSchema(columns)
+    rows = 0
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        for batch in batches:
+            if batch:
+                writer.write_batch(recordBatch(schema, batch))
+                rows += len(batch)
+    return rows
+
+def writeArrow(path, columns, batches):
+    schema = arrowSchema(columns)
+    rows = 0
+    with pa.OSFile(path, 'wb') as sink, \
+            pa.ipc.new_file(sink, schema, options=pa.ipc.IpcWriteOptions(compression='zstd')) as writer:
+        for batch in batches:
+            if batch:
+                writer.write_batch(recordBatch(schema, batch))
+                rows += len(batch)
+    return rows
+
+def csvValue(value):
+    if value is None:
+        return ''
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+def writeCsv(path, columns, batches):
+    rows = 0
+    with gzip.open(path, 'wt', newline='', encoding='utf-8', compresslevel=6) as file:
+        writer = csv.writer(file)
+        writer.writerow([name for name, _ in columns])
+        for batch in batches:
+            writer.writerows([csvValue(value) for value in row] for row in batch)
+            rows += len(batch)
+    return rows
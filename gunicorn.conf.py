@@ -0,0 +1,38 @@
+#------------------------------------------------
+# gunicorn configuration - gunicorn -c gunicorn.conf.py
+#------------------------------------------------
+import gc
+import multiprocessing
+import os
+
+wsgi_app = 'app:create_app()'
+bind = os.environ.get('LIBRARY_BIND', '0.0.0.0:8000')
+
+# threaded workers: requests mostly wait on the database, a few threads per process overlap that
+worker_class = os.environ.get('LIBRARY_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('LIBRARY_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('LIBRARY_THREADS', 4))
+
+# import & build the app once in the master, workers are forked from it - fast boot and the
+# code / config pages stay shared between workers (copy-on-write)
+preload_app = True
+
+timeout = int(os.environ.get('LIBRARY_TIMEOUT', 30))
+keepalive = 5
+max_requests = int(os.environ.get('LIBRARY_MAX_REQUESTS', 10000))   # recycle workers to bound memory growth
+max_requests_jitter = max_requests // 10
+
+# move everything the master allocated to the permanent generation, so the garbage collector of
+# the workers doesn't touch (and copy) those pages
+def when_ready(server):
+    gc.freeze()
+
+# connections must never be shared across processes: drop the pool inherited from the master
+# (close=False leaves the master's sockets alone), every worker opens its own on first use
+def post_fork(server, worker):
+    from app import db
+
+    app = server.app.wsgi()
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
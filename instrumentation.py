@@ -0,0 +1,224 @@
+#------------------------------------------------
+# imports
+#------------------------------------------------
+import cProfile
+import os
+import random
+import threading
+import time
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+
+#------------------------------------------------
+# Metric types (Prometheus text exposition format)
+#------------------------------------------------
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+def formatLabels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelValues, amount=1):
+        with self._lock:
+            self._values[labelValues] = self._values.get(labelValues, 0) + amount
+
+    def value(self, *labelValues):
+        return self._values.get(labelValues, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labelValues, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{formatLabels(self.labels, labelValues)} {value}")
+        return lines
+
+class Gauge(Counter):
+    def set(self, *labelValues, value):
+        with self._lock:
+            self._values[labelValues] = value
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}   # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, *labelValues, value):
+        with self._lock:
+            series = self._series.get(labelValues)
+            if series is None:
+                series = self._series[labelValues] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labelValues, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{formatLabels(self.labels, labelValues, [('le', bound)])} {count}")
+                lines.append(f"{self.name}_bucket{formatLabels(self.labels, labelValues, [('le', '+Inf')])} {series[-1]}")
+                lines.append(f"{self.name}_sum{formatLabels(self.labels, labelValues)} {series[-2]}")
+                lines.append(f"{self.name}_count{formatLabels(self.labels, labelValues)} {series[-1]}")
+        return lines
+
+# every metric of the process, rendered together at /metrics
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+registry = MetricsRegistry()
+
+requestDuration = registry.histogram(
+    'library_http_request_duration_seconds', 'Request latency.', ('method', 'route', 'status'))
+sqlQueries = registry.histogram(
+    'library_sql_queries_per_request', 'SQL statements executed per request.', ('route',), COUNT_BUCKETS)
+sqlDuration = registry.histogram(
+    'library_sql_duration_seconds_per_request', 'Time spent executing SQL per request.', ('route',))
+serializationDuration = registry.histogram(
+    'library_serialization_duration_seconds', 'Time spent encoding JSON responses.', ('route',))
+profilesWritten = registry.counter(
+    'library_profiles_written_total', 'cProfile dumps written.', ('route',))
+
+#------------------------------------------------
+# SQL instrumentation - counts statements of the current request
+# (registered on the app's engines by initMetrics only, statements cost nothing extra otherwise)
+#------------------------------------------------
+
+def startQueryTimer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+def stopQueryTimer(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    if has_request_context() and 'sql_queries' in g:
+        g.sql_queries += 1
+        g.sql_time += time.perf_counter() - started
+
+#------------------------------------------------
+# Flask integration
+#------------------------------------------------
+
+def routeLabel():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+# Opt-in instrumentation of a Flask app:
+#   METRICS_ENABLED         - per route latency / SQL count & time / JSON encoding histograms at /metrics
+#   PROFILING_ENABLED       - cProfile a request when it carries the PROFILE_HEADER header ...
+#   PROFILE_SAMPLE_RATE     - ... or for this fraction of all requests (0 - 1)
+#   PROFILE_DIR             - where the .prof dumps are written (path returned in X-Profile-File)
+def init_instrumentation(app):
+    if app.config.get('METRICS_ENABLED'):
+        initMetrics(app)
+    if app.config.get('PROFILING_ENABLED'):
+        initProfiling(app)
+
+def initMetrics(app):
+    with app.app_context():
+        engines = list(app.extensions['sqlalchemy'].engines.values())
+    for engine in engines:
+        if not event.contains(engine, 'before_cursor_execute', startQueryTimer):
+            event.listen(engine, 'before_cursor_execute', startQueryTimer)
+            event.listen(engine, 'after_cursor_execute', stopQueryTimer)
+
+    @app.before_request
+    def startRequestMetrics():
+        g.request_started = time.perf_counter()
+        g.sql_queries = 0
+        g.sql_time = 0.0
+        g.serialization_time = 0.0
+
+    @app.after_request
+    def recordRequestMetrics(response):
+        if 'request_started' in g:
+            route = routeLabel()
+            requestDuration.observe(request.method, route, str(response.status_code),
+                                    value=time.perf_counter() - g.request_started)
+            sqlQueries.observe(route, value=g.sql_queries)
+            sqlDuration.observe(route, value=g.sql_time)
+            serializationDuration.observe(route, value=g.serialization_time)
+        return response
+
+    # time spent in the JSON provider (jsonify)
+    encode = app.json.response
+
+    def timedResponse(*args, **kwargs):
+        started = time.perf_counter()
+        response = encode(*args, **kwargs)
+        if has_request_context() and 'serialization_time' in g:
+            g.serialization_time += time.perf_counter() - started
+        return response
+
+    app.json.response = timedResponse
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+def initProfiling(app):
+    header = app.config.get('PROFILE_HEADER', 'X-Profile')
+    sampleRate = float(app.config.get('PROFILE_SAMPLE_RATE', 0.0))
+    profileDir = app.config.get('PROFILE_DIR', 'profiles')
+
+    @app.before_request
+    def startProfiler():
+        if request.headers.get(header) or (sampleRate and random.random() < sampleRate):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.after_request
+    def stopProfiler(response):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return response
+        profiler.disable()
+        route = routeLabel()
+        os.makedirs(profileDir, exist_ok=True)
+        fileName = f"{route.strip('/').replace('/', '_').replace('<', '').replace('>', '') or 'root'}-{time.time_ns()}.prof"
+        profiler.dump_stats(os.path.join(profileDir, fileName))
+        profilesWritten.inc(route)
+        response.headers['X-Profile-File'] = fileName
+        return response
@@ -0,0 +1,80 @@
+#------------------------------------------------
+# imports
+#------------------------------------------------
+from bisect import bisect_left, bisect_right
+
+#------------------------------------------------
+# Interval index
+#
+# Half-open [start, end) intervals kept sorted by start, next to the running maximum of their
+# ends. Since that maximum never decreases, both bounds of an overlap query are binary searches:
+#   - intervals starting before `end` are a prefix of the list (bisect on the starts)
+#   - intervals before the first running max > `start` all ended before it (bisect on the maxima)
+# so "does anything overlap [start, end)" is O(log n), listing the overlaps O(log n + k).
+# Works with any ordered values (datetimes for the loans), end=None means unbounded.
+#------------------------------------------------
+
+class IntervalIndex:
+    # intervals: iterable of (start, end, key) - key identifies the interval in the results (e.g. a loan id)
+    def __init__(self, intervals=()):
+        self._starts = []
+        self._ends = []
+        self._keys = []
+        self._maxEnds = []
+        self._unbounded = None   # position of the first unbounded interval, everything after it overlaps
+        for start, end, key in sorted(intervals, key=lambda interval: interval[0]):
+            self.append(start, end, key)
+
+    # adds an interval starting at or after every indexed one (ordered bulk loads); O(1)
+    def append(self, start, end, key=None):
+        if self._starts and start < self._starts[-1]:
+            raise ValueError("Intervals must be appended in start order.")
+        if end is None and self._unbounded is None:
+            self._unbounded = len(self._starts)
+        self._starts.append(start)
+        self._ends.append(end)
+        self._keys.append(key)
+        if self._unbounded is None:
+            self._maxEnds.append(end if not self._maxEnds else max(self._maxEnds[-1], end))
+
+    # number of leading intervals that start before `end` (all of them for end=None)
+    def _startingBefore(self, end):
+        return len(self._starts) if end is None else bisect_left(self._starts, end)
+
+    # index of the first interval that may still run at `start`
+    def _firstRunningAt(self, start):
+        return bisect_right(self._maxEnds, start)
+
+    def overlaps(self, start, end=None):
+        stop = self._startingBefore(end)
+        if stop == 0:
+            return False
+        if self._unbounded is not None and stop > self._unbounded:
+            return True
+        return self._maxEnds[stop - 1] > start
+
+    # (start, end, key) of every interval overlapping [start, end), by start
+    def overlapping(self, start, end=None):
+        stop = self._startingBefore(end)
+        return [
+            (self._starts[i], self._ends[i], self._keys[i])
+            for i in range(self._firstRunningAt(start), stop)
+            if self._ends[i] is None or self._ends[i] > start
+        ]
+
+    # free [start, end) windows between the intervals within [start, end) - end=None leaves the last one open
+    def gaps(self, start, end=None):
+        gaps = []
+        cursor = start
+        for intervalStart, intervalEnd, _ in self.overlapping(start, end):
+            if intervalStart > cursor:
+                gaps.append((cursor, intervalStart))
+            if intervalEnd is None:
+                return gaps
+            cursor = max(cursor, intervalEnd)
+        if end is None or cursor < end:
+            gaps.append((cursor, end))
+        return gaps
+
+    def __len__(self):
+        return len(self._starts)
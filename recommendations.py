@@ -0,0 +1,83 @@
+#------------------------------------------------
+# imports
+#------------------------------------------------
+import math
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:  # optional - pip install -r requirements-recommendations.txt, pure Python otherwise
+    np = None
+
+#------------------------------------------------
+# "Also borrowed" - item-item similarity over the customer x book borrow matrix
+#
+# X[c, b] = 1 when customer c borrowed book b (how often doesn't matter). (X.T @ X)[a, b] counts
+# the customers who borrowed both books, divided by sqrt(borrowers(a) * borrowers(b)) it is the
+# cosine similarity of the two book columns. Only the k best neighbours of a book are kept, ties
+# broken by book id so both implementations return the same lists.
+#------------------------------------------------
+
+BLOCK_SIZE = 1024   # books whose co-borrow counts are multiplied out at once (bounds the memory of X.T @ X)
+
+# batches: iterable of sequences of (customer_id, book_id) rows - duplicates are fine
+# books: ids of the books to compute the neighbours of (None = every book)
+# returns {book_id: [(similar_book_id, score, co_borrowers), ...] best first} for the books with loans
+def topNeighbours(batches, books=None, k=20):
+    if np is not None:
+        return topNeighboursSparse(batches, books, k)
+    return topNeighboursPython(batches, books, k)
+
+def topNeighboursSparse(batches, books, k):
+    pairs = [np.asarray(batch, dtype=np.int64).reshape(-1, 2) for batch in batches]
+    if not pairs:
+        return {}
+    pairs = np.concatenate(pairs)
+
+    # ids -> dense row / column numbers
+    customerIDs, rows = np.unique(pairs[:, 0], return_inverse=True)
+    bookIDs, columns = np.unique(pairs[:, 1], return_inverse=True)
+    matrix = sparse.csr_matrix((np.ones(len(pairs)), (rows, columns)), shape=(len(customerIDs), len(bookIDs)))
+    matrix.data[:] = 1   # repeated loans were summed up - back to 0/1
+    transposed = matrix.T.tocsr()
+    borrowers = np.asarray(matrix.sum(axis=0)).ravel()
+
+    targets = np.arange(len(bookIDs)) if books is None else np.flatnonzero(np.isin(bookIDs, list(books)))
+    neighbours = {}
+    for blockStart in range(0, len(targets), BLOCK_SIZE):
+        block = targets[blockStart:blockStart + BLOCK_SIZE]
+        counts = (transposed[block] @ matrix).tocsr()
+        for row, column in enumerate(block):
+            others = counts.indices[counts.indptr[row]:counts.indptr[row + 1]]
+            together = counts.data[counts.indptr[row]:counts.indptr[row + 1]]
+            keep = others != column
+            others, together = others[keep], together[keep]
+            scores = together / np.sqrt(borrowers[column] * borrowers[others])
+            best = np.lexsort((bookIDs[others], -scores))[:k]
+            neighbours[int(bookIDs[column])] = [
+                (int(bookIDs[others[i]]), float(scores[i]), int(together[i])) for i in best
+            ]
+    return neighbours
+
+def topNeighboursPython(batches, books, k):
+    borrowersOf = {}   # book -> customers
+    borrowedBy = {}    # customer -> books
+    for batch in batches:
+        for customerID, bookID in batch:
+            borrowersOf.setdefault(bookID, set()).add(customerID)
+            borrowedBy.setdefault(customerID, set()).add(bookID)
+
+    targets = borrowersOf if books is None else [bookID for bookID in books if bookID in borrowersOf]
+    neighbours = {}
+    for bookID in targets:
+        together = {}
+        for customerID in borrowersOf[bookID]:
+            for other in borrowedBy[customerID]:
+                if other != bookID:
+                    together[other] = together.get(other, 0) + 1
+        scored = [
+            (other, count / math.sqrt(len(borrowersOf[bookID]) * len(borrowersOf[other])), count)
+            for other, count in together.items()
+        ]
+        neighbours[bookID] = sorted(scored, key=lambda neighbour: (-neighbour[1], neighbour[0]))[:k]
+    return neighbours
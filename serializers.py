@@ -0,0 +1,71 @@
+#------------------------------------------------
+# imports
+#------------------------------------------------
+from datetime import date, datetime
+from decimal import Decimal
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # optional - the stdlib json module is used without it
+    orjson = None
+
+#------------------------------------------------
+# Schemas - the fields exposed for every model, in output order
+#------------------------------------------------
+
+BOOK_FIELDS = ('id', 'name', 'author', 'year_published', 'type', 'is_available')
+CUSTOMER_FIELDS = ('id', 'name', 'city', 'age')
+LOAN_FIELDS = ('id', 'customer_id', 'book_id', 'loan_date', 'return_date', 'due_date')
+ARCHIVED_LOAN_FIELDS = LOAN_FIELDS + ('archived_at',)
+
+# table columns of a schema, to select row tuples with Core instead of hydrating ORM objects
+def columnsFor(model, fields, prefix=''):
+    return [model.__table__.c[name].label(prefix + name) for name in fields]
+
+# dictionary of a row tuple selected with columnsFor (fields in the same order)
+def rowToDict(row, fields, offset=0):
+    return dict(zip(fields, row[offset:offset + len(fields)]))
+
+# dictionary of an ORM object
+def objectToDict(obj, fields):
+    return {name: getattr(obj, name) for name in fields}
+
+#------------------------------------------------
+# JSON provider
+#------------------------------------------------
+
+# types the json encoders don't handle natively; dates are always ISO 8601
+def jsonDefault(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+# Flask JSON provider using orjson when it is installed (several times faster for large lists),
+# the stdlib encoder otherwise. Both produce the same output format.
+class FastJSONProvider(DefaultJSONProvider):
+    default = staticmethod(jsonDefault)
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.dumps(obj, default=jsonDefault, option=orjson.OPT_NON_STR_KEYS).decode()
+        kwargs.setdefault('separators', (',', ':'))   # compact, like orjson
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if orjson is not None:
+            body = orjson.dumps(obj, default=jsonDefault, option=orjson.OPT_NON_STR_KEYS)
+        else:
+            body = self.dumps(obj)
+        return self._app.response_class(body, mimetype=self.mimetype)
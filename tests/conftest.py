@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pytest
+from sqlalchemy import event
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app import create_app, create_tables, db, import_json_file
+from config import TestingConfig
+
+# app on an in-memory database loaded with the mockup data
+@pytest.fixture
+def app():
+    app = create_app(TestingConfig)
+    with app.app_context():
+        create_tables()
+        for source in ('books', 'customers', 'loans'):
+            import_json_file(source, os.path.join(ROOT, 'mockup', f'{source}.json'))
+    return app
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+# list of the SQL statements executed while the test runs
+@pytest.fixture
+def queries(app):
+    statements = []
+
+    def countQuery(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', countQuery)
+    yield statements
+    event.remove(engine, 'before_cursor_execute', countQuery)
@@ -0,0 +1,18 @@
+# the detail & expanded list endpoints load their relations eagerly, in a fixed number of queries
+
+def test_book_details_query_count(client, queries):
+    response = client.get('/books/1')
+    assert response.status_code == 200
+    assert response.json['loans']
+    assert len(queries) == 2
+
+def test_customer_details_query_count(client, queries):
+    response = client.get('/customers/1')
+    assert response.status_code == 200
+    assert len(queries) == 2
+
+def test_list_loans_expanded_query_count(client, queries):
+    response = client.get('/listLoans?expand=book,customer')
+    assert response.status_code == 200
+    assert all('book' in loan and 'customer' in loan for loan in response.json)
+    assert len(queries) == 1
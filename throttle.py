@@ -0,0 +1,146 @@
+#------------------------------------------------
+# imports
+#------------------------------------------------
+import math
+import threading
+import time
+from functools import wraps
+from flask import current_app, jsonify, request
+from instrumentation import registry, routeLabel
+
+#------------------------------------------------
+# Per client token bucket rate limiter
+#------------------------------------------------
+
+# every client gets `burst` tokens, refilled at `rate` tokens per second; a request takes one.
+# Buckets live in the process - with N workers a client gets up to N times the limit.
+class TokenBucketLimiter:
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = {}   # client -> [tokens, updated_at]
+        self._lock = threading.Lock()
+
+    # 0 if the request may proceed, otherwise the seconds until the client gets a token back
+    def acquire(self, client):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                if len(self._buckets) >= self.max_clients:
+                    self._dropFullBuckets(now)
+                bucket = self._buckets[client] = [self.burst, now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0.0
+            bucket[0] = tokens
+            return (1 - tokens) / self.rate
+
+    # clients idle long enough to be back at a full bucket are indistinguishable from new ones
+    def _dropFullBuckets(self, now):
+        for client, (tokens, updated_at) in list(self._buckets.items()):
+            if tokens + (now - updated_at) * self.rate >= self.burst:
+                del self._buckets[client]
+
+    def __len__(self):
+        return len(self._buckets)
+
+#------------------------------------------------
+# Single-flight - concurrent identical calls share one computation
+#------------------------------------------------
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    # returns (result, shared) - the first caller of a key runs fn, callers arriving while it runs
+    # wait for its result (or its exception). A waiter gives up after `timeout` seconds and runs fn itself.
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if call.done.wait(self.timeout):
+                if call.error is not None:
+                    raise call.error
+                return call.result, True
+            return fn(), False
+
+        try:
+            call.result = fn()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+#------------------------------------------------
+# Flask integration
+#------------------------------------------------
+
+rateLimitedRequests = registry.counter(
+    'library_rate_limited_requests_total', 'Requests rejected with 429 by the rate limiter.', ('route', 'bucket'))
+coalescedRequests = registry.counter(
+    'library_coalesced_requests_total', 'Requests answered with the result of an identical in-flight request.', ('route',))
+
+# Throttling of a Flask app:
+#   RATE_LIMIT_ENABLED        - per client token buckets for the routes decorated with rateLimited
+#   RATE_LIMITS               - bucket name -> (tokens per second, burst)
+#   RATE_LIMIT_CLIENT_HEADER  - header identifying the client (the remote address without it)
+#   COALESCE_ENABLED          - single-flight for coalesce() (used by the response cache)
+#   COALESCE_TIMEOUT          - seconds a request waits for an identical one before computing itself
+def init_throttling(app):
+    if app.config.get('RATE_LIMIT_ENABLED'):
+        app.extensions['rate_limiters'] = {
+            name: TokenBucketLimiter(rate, burst) for name, (rate, burst) in app.config['RATE_LIMITS'].items()
+        }
+    if app.config.get('COALESCE_ENABLED'):
+        app.extensions['single_flight'] = SingleFlight(app.config.get('COALESCE_TIMEOUT', 30))
+
+def clientKey():
+    header = current_app.config.get('RATE_LIMIT_CLIENT_HEADER')
+    return (header and request.headers.get(header)) or request.remote_addr or 'unknown'
+
+# 429 + Retry-After once the client used up its tokens of the given bucket
+def rateLimited(bucket):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            limiter = current_app.extensions.get('rate_limiters', {}).get(bucket)
+            if limiter is not None:
+                retryAfter = limiter.acquire(clientKey())
+                if retryAfter:
+                    rateLimitedRequests.inc(routeLabel(), bucket)
+                    response = jsonify({"error": "Too many requests. Retry later."})
+                    response.headers['Retry-After'] = str(math.ceil(retryAfter))
+                    return response, 429
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# runs fn once for concurrent callers of the same key, returns (result, shared)
+def coalesce(key, fn):
+    singleFlight = current_app.extensions.get('single_flight')
+    if singleFlight is None:
+        return fn(), False
+    result, shared = singleFlight.do(key, fn)
+    if shared:
+        coalescedRequests.inc(routeLabel())
+    return result, shared